@@ -1,10 +1,21 @@
 from requests.exceptions import RequestException
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 import pandas as pd
 import requests
 import numpy as np
 import json
+import random
+import threading
+import time
 from Bio import Entrez
 
+BIOC_URL = 'https://www.ncbi.nlm.nih.gov/research/bionlp/RESTful/pmcoa.cgi/BioC_{format}/PMC{id}/{encode}'
+# NCBI allows 10 requests per second with an API key
+NCBI_RATE_LIMIT = 10
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
 # Fetch article ids based on keywords
 def fetch_article_id(keyword, mindate, maxdate, db='pmc', retmax=20, retmode='json'):
     """
@@ -39,31 +50,106 @@ def fetch_article_id(keyword, mindate, maxdate, db='pmc', retmax=20, retmode='js
     return data, article_ids
 
 
+class RateLimiter:
+    """Thread safe limiter that spaces out requests to at most `rate` per second."""
+    def __init__(self, rate=NCBI_RATE_LIMIT):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# One limiter per host, shared by every worker thread
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(url, rate=NCBI_RATE_LIMIT):
+    host = urlparse(url).netloc
+    with _RATE_LIMITERS_LOCK:
+        if host not in _RATE_LIMITERS:
+            _RATE_LIMITERS[host] = RateLimiter(rate)
+        return _RATE_LIMITERS[host]
+
+
+def make_session(pool_size=10):
+    """requests.Session with a keep-alive connection pool big enough for the workers."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Per request timings of the last run_script call
+_FETCH_TIMINGS = []
+
+
+def get_fetch_timings():
+    """Timings of every BioC request made by the last run_script call."""
+    return list(_FETCH_TIMINGS)
+
+
 # Fetch meta data of the collected articles
-def fetch_data(id):
+def fetch_data(id, session=None, base_url=BIOC_URL, timeout=10, retries=0, backoff=0.5, rate=None):
     """
     Fetch data of an full text article using its PMC ID.
     Parameters:
         id (str): The PMC ID of the article.
+        session (requests.Session): Optional pooled session (default is a one-off request).
+        base_url (str): BioC URL template with {format}, {id} and {encode} fields.
+        timeout (float): Timeout of every attempt in seconds.
+        retries (int): Number of retries on connection errors, 429 and 5xx responses.
+        backoff (float): Base delay of the jittered exponential backoff in seconds.
+        rate (float): Maximum requests per second to the host (default is no limit).
     Returns:
         dict or None: The metadata in JSON format, or None if an error occurs.
     """
     format = 'json'
     encode = 'unicode'
-    url = f'https://www.ncbi.nlm.nih.gov/research/bionlp/RESTful/pmcoa.cgi/BioC_{format}/PMC{id}/{encode}'
-    
-    try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status() 
+    url = base_url.format(format=format, id=id, encode=encode)
+    getter = session if session is not None else requests
+    limiter = get_rate_limiter(url, rate) if rate else None
+
+    start = time.perf_counter()
+    attempt = 0
+    json_data = None
+    status = None
+    while True:
+        if limiter:
+            limiter.wait()
         try:
-            json_data = response.json()
-            return json_data
-        except ValueError as e:
-            print(f"JSON parsing error: {e}")
-            return None
-    except RequestException as e:
-        print(f"Request failed: {e}")
-        return None
+            response = getter.get(url, timeout=timeout)
+            status = response.status_code
+            if status in RETRY_STATUS and attempt < retries:
+                raise RequestException(f"HTTP {status}")
+            response.raise_for_status()
+            try:
+                json_data = response.json()
+            except ValueError as e:
+                print(f"JSON parsing error: {e}")
+            break
+        except RequestException as e:
+            if attempt >= retries or (status is not None and status not in RETRY_STATUS):
+                print(f"Request failed: {e}")
+                break
+            # Full jitter exponential backoff
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+            attempt += 1
+            status = None
+
+    _FETCH_TIMINGS.append({'id': id,
+                           'status': status,
+                           'attempts': attempt + 1,
+                           'seconds': round(time.perf_counter() - start, 4)})
+    return json_data
 
 # Parse the article info 
 def parse_article_info(json_data):
@@ -139,28 +225,94 @@ def parse_article_info(json_data):
     return article_info
 
 
-# Clean and store the article info in a dataframe
-def run_script(ids):
+def fetch_and_parse(id, store=None, **fetch_kwargs):
+    """Fetch one article and parse it (empty dict on failure), consulting the article store first."""
+    if store is not None:
+        cached = store.get(id)
+        if cached is not None:
+            return cached
+        if store.offline:
+            return {}
+    try:
+        data = fetch_data(id, **fetch_kwargs)
+        if data:
+            article_data = parse_article_info(data)
+            if store is not None and article_data:
+                store.put(id, data, article_data)
+            return article_data
+    except Exception as e:
+        print(f'Error: {e}')
+    return {}
+
+
+def iter_articles(ids, max_workers=8, rate=NCBI_RATE_LIMIT, retries=2, backoff=0.5, timeout=10, base_url=BIOC_URL,
+                  store=None, ordered=False):
     """
-    Fetches and processes metadata for a list of PMC article IDs.
+    Fetch and parse articles, yielding each one as soon as it is ready.
     Parameters:
         ids (list): A list of PMC article IDs.
-    Returns:
-        pandas.DataFrame: A DataFrame containing processed article information.
+        ordered (bool): Yield in the order of ids instead of completion order.
+        Other parameters as in run_script.
+    Yields:
+        tuple: (id, article_data) where article_data is the parse_article_info dict (empty on failure).
     """
-    info = {}
-    for id in ids:
-        try: 
-            data = fetch_data(id)
-            if data:
-                article_data = parse_article_info(data)
-                info.update(article_data)
-        except Exception as e:
-            print(f'Error: {e}')
+    fetch_kwargs = {'base_url': base_url, 'timeout': timeout, 'retries': retries, 'backoff': backoff, 'rate': rate,
+                    'store': store}
+    with make_session(max(max_workers, 1)) as session:
+        fetch_kwargs['session'] = session
+        if max_workers <= 1:
+            for id in ids:
+                yield id, fetch_and_parse(id, **fetch_kwargs)
+            return
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = {executor.submit(fetch_and_parse, id, **fetch_kwargs): id for id in ids}
+            if ordered:
+                # futures was filled in the order of ids
+                completed = list(futures)
+            else:
+                completed = as_completed(futures)
+            for future in completed:
+                yield futures[future], future.result()
+        finally:
+            # Stops queued requests when the consumer goes away (e.g. a Streamlit rerun) and waits for
+            # the running ones, which write through to the store so a later call reads them back
+            executor.shutdown(wait=True, cancel_futures=True)
+
 
+def articles_to_df(info):
+    """Build the article DataFrame from {pmcid: article_info}."""
     df_article = pd.DataFrame.from_dict(info, orient='index')
     df_article.reset_index(inplace=True)
     df_article.rename(columns={'index': 'pmcid'}, inplace=True)
+    if df_article.empty:
+        return df_article
     df_article['pmcid'] = df_article['pmcid'].apply(lambda x: 'PMC' + str(x) if not str(x).startswith('PMC') else x)
     df_article.dropna(subset=['Title', 'Abstract', 'Introduction'], inplace=True)
-    return df_article
\ No newline at end of file
+    return df_article
+
+
+# Clean and store the article info in a dataframe
+def run_script(ids, max_workers=8, rate=NCBI_RATE_LIMIT, retries=2, backoff=0.5, timeout=10, base_url=BIOC_URL,
+               store=None):
+    """
+    Fetches and processes metadata for a list of PMC article IDs.
+    Parameters:
+        ids (list): A list of PMC article IDs.
+        max_workers (int): Number of concurrent requests (1 fetches serially).
+        rate (float): Maximum requests per second to the BioC host.
+        retries (int): Retries per article on transient errors.
+        backoff (float): Base delay of the jittered retry backoff in seconds.
+        timeout (float): Timeout of every request in seconds.
+        base_url (str): BioC URL template (e.g. a local stub server for testing).
+        store (ArticleStore): Optional local article store, read first and written through on a miss.
+    Returns:
+        pandas.DataFrame: A DataFrame containing processed article information.
+    """
+    _FETCH_TIMINGS.clear()
+    info = {}
+    for _, article_data in iter_articles(list(ids), max_workers=max_workers, rate=rate, retries=retries,
+                                         backoff=backoff, timeout=timeout, base_url=base_url, store=store,
+                                         ordered=True):
+        info.update(article_data)
+    return articles_to_df(info)
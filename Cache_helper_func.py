@@ -0,0 +1,482 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+import numpy as np
+
+CACHE_DIR = os.environ.get('ARTICLE_CACHE_DIR', 'cache')
+
+
+def text_hash(text):
+    """Stable content hash of a text."""
+    return hashlib.sha1((text or '').encode('utf-8')).hexdigest()
+
+
+def atomic_write_json(path, obj):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+# Embedding storage precision --> (numpy dtype, file suffix)
+STORAGE_MODES = {'float32': (np.float32, 'f32'), 'float16': (np.float16, 'f16'), 'int8': (np.int8, 'i8')}
+
+
+def quantize(vectors, storage='float32'):
+    """
+    Compact representation of float32 vectors.
+    Returns:
+        tuple: (codes in the storage dtype, float32 per vector scales for int8 else None)
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if storage == 'int8':
+        # Symmetric per vector scale, so every vector uses the full int8 range
+        scales = np.maximum(np.abs(vectors).max(axis=-1), 1e-12) / 127
+        codes = np.clip(np.rint(vectors / scales[..., None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    return vectors.astype(STORAGE_MODES[storage][0]), None
+
+
+def dequantize(codes, scales=None):
+    """float32 vectors back from quantize output (always a copy, never a view of a memory map)."""
+    vectors = np.array(codes, dtype=np.float32)
+    return vectors * scales[..., None] if scales is not None else vectors
+
+
+class EmbeddingCache:
+    """
+    On disk embedding store backed by a memory mapped matrix plus a JSON index.
+    storage is 'float32', 'float16' (half the size) or 'int8' (a quarter, plus one float32
+    scale per vector). The compact modes keep a memory mapped float32 sidecar that is only
+    read to rescore a few candidates exactly (get_exact_many). Keys are content addressed
+    (pmcid, section, model name, text hash) and the least recently used entries are evicted
+    once max_items is reached.
+    """
+    def __init__(self, cache_dir=None, dim=768, max_items=20000, initial_capacity=1024, storage='float32'):
+        if storage not in STORAGE_MODES:
+            raise ValueError(f"Unknown storage {storage!r}, expected one of {list(STORAGE_MODES)}")
+        self.cache_dir = cache_dir or os.path.join(CACHE_DIR, 'embeddings')
+        self.dim = dim
+        self.max_items = max_items
+        self.storage = storage
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._vectors_path = os.path.join(self.cache_dir, f'vectors.{STORAGE_MODES[storage][1]}')
+        self._scales_path = os.path.join(self.cache_dir, 'scales.f32')
+        self._exact_path = os.path.join(self.cache_dir, 'exact.f32') if storage != 'float32' else None
+        self._index_path = os.path.join(self.cache_dir, 'index.json')
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # key --> row, ordered from least to most recently used
+        self._rows = OrderedDict()
+        self._free_rows = []
+        self._capacity = 0
+        self._vectors = None
+        self._scales = None
+        self._exact = None
+        self._load(initial_capacity)
+
+    @staticmethod
+    def make_key(pmcid, section, model_name, text):
+        return f'{pmcid}|{section}|{model_name}|{text_hash(text)}'
+
+    def _open(self, capacity, mode):
+        self._vectors = np.memmap(self._vectors_path, dtype=STORAGE_MODES[self.storage][0], mode=mode,
+                                  shape=(capacity, self.dim))
+        if self.storage == 'int8':
+            self._scales = np.memmap(self._scales_path, dtype=np.float32, mode=mode, shape=(capacity,))
+        if self._exact_path is not None:
+            self._exact = np.memmap(self._exact_path, dtype=np.float32, mode=mode, shape=(capacity, self.dim))
+
+    def _load(self, initial_capacity):
+        if os.path.exists(self._index_path) and os.path.exists(self._vectors_path):
+            with open(self._index_path) as f:
+                index = json.load(f)
+            # Compact caches written before the float32 sidecar existed are rebuilt
+            has_exact = self._exact_path is None or (index.get('exact') and os.path.exists(self._exact_path))
+            if index.get('dim') == self.dim and index.get('storage', 'float32') == self.storage and has_exact:
+                self._capacity = index['capacity']
+                self._rows = OrderedDict((key, row) for key, row in index['entries'])
+                self._free_rows = index.get('free', [])
+                self._open(self._capacity, 'r+')
+                return
+            print(f"Embedding cache layout changed ({index.get('dim')}/{index.get('storage', 'float32')}"
+                  f"{'' if has_exact else ' without float32 sidecar'} -> "
+                  f"{self.dim}/{self.storage}), starting fresh")
+        self._capacity = min(initial_capacity, self.max_items)
+        self._rows = OrderedDict()
+        self._free_rows = list(range(self._capacity))
+        self._open(self._capacity, 'w+')
+        self._save_index()
+
+    def _save_index(self):
+        atomic_write_json(self._index_path, {'dim': self.dim,
+                                              'storage': self.storage,
+                                              'exact': self._exact_path is not None,
+                                              'capacity': self._capacity,
+                                              'entries': list(self._rows.items()),
+                                              'free': self._free_rows})
+
+    def _grow(self, needed):
+        # Re-create the memory maps with a bigger shape (capped by max_items)
+        new_capacity = min(max(self._capacity * 2, self._capacity + needed), self.max_items)
+        if new_capacity <= self._capacity:
+            return
+        arrays = [(self._vectors_path, self._vectors, (self.dim,))]
+        if self._scales is not None:
+            arrays.append((self._scales_path, self._scales, ()))
+        if self._exact is not None:
+            arrays.append((self._exact_path, self._exact, (self.dim,)))
+        for path, array, row_shape in arrays:
+            array.flush()
+            grown = np.memmap(f'{path}.tmp', dtype=array.dtype, mode='w+', shape=(new_capacity,) + row_shape)
+            grown[:self._capacity] = array[:]
+            grown.flush()
+            del grown
+        self._vectors = self._scales = self._exact = None
+        for path, _, _ in arrays:
+            os.replace(f'{path}.tmp', path)
+        self._open(new_capacity, 'r+')
+        self._free_rows.extend(range(self._capacity, new_capacity))
+        self._capacity = new_capacity
+
+    def _take_row(self):
+        if not self._free_rows:
+            self._grow(1)
+        if not self._free_rows:
+            # Cache is full --> evict the least recently used entry
+            _, row = self._rows.popitem(last=False)
+            return row
+        return self._free_rows.pop()
+
+    def get_many(self, keys):
+        """Return {key: vector} for the cached keys and count hits/misses."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                row = self._rows.get(key)
+                if row is None:
+                    self.misses += 1
+                    continue
+                self._rows.move_to_end(key)
+                found[key] = dequantize(self._vectors[row], self._scales[row] if self._scales is not None else None)
+                self.hits += 1
+        return found
+
+    def get_exact_many(self, keys):
+        """
+        Return {key: float32 vector} for the cached keys from the float32 sidecar (the stored vectors
+        when storage is float32). Only the requested rows are read and the stats are not counted.
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                row = self._rows.get(key)
+                if row is None:
+                    continue
+                if self._exact is not None:
+                    found[key] = np.array(self._exact[row])
+                else:
+                    found[key] = dequantize(self._vectors[row])
+        return found
+
+    def put_many(self, keys, vectors):
+        """Store the vectors (one row per key) and persist the index."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(keys) == 0:
+            return
+        if vectors.shape != (len(keys), self.dim):
+            raise ValueError(f"Expected vectors of shape {(len(keys), self.dim)}, got {vectors.shape}")
+        codes, scales = quantize(vectors, self.storage)
+        with self._lock:
+            for i, key in enumerate(keys):
+                row = self._rows.get(key)
+                if row is None:
+                    row = self._take_row()
+                self._vectors[row] = codes[i]
+                if scales is not None:
+                    self._scales[row] = scales[i]
+                if self._exact is not None:
+                    self._exact[row] = vectors[i]
+                self._rows[key] = row
+                self._rows.move_to_end(key)
+            self._vectors.flush()
+            if self._scales is not None:
+                self._scales.flush()
+            if self._exact is not None:
+                self._exact.flush()
+            self._save_index()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def stats(self):
+        """Hit/miss counters and size of the cache."""
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+                'items': len(self._rows),
+                'capacity': self._capacity,
+                'max_items': self.max_items,
+                'storage': self.storage,
+                'bytes': self._vectors.nbytes + (self._scales.nbytes if self._scales is not None else 0),
+                'exact_bytes': self._exact.nbytes if self._exact is not None else 0}
+
+
+def frame_fingerprint(df, columns=('pmcid', 'Abstract')):
+    """Content hash of the given columns of a DataFrame (changes when rows are added, removed or edited)."""
+    import pandas as pd
+    values = pd.util.hash_pandas_object(df[list(columns)], index=False).values
+    return hashlib.sha1(values.tobytes()).hexdigest()
+
+
+class RecommendationCache:
+    """
+    Bounded in memory LRU of recommendation results shared by all sessions. get_or_compute runs
+    the computation once per key even when several reruns ask for it concurrently.
+    """
+    def __init__(self, max_items=512):
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._key_locks = {}
+
+    @staticmethod
+    def make_key(pmcid, df, method, **params):
+        """(selected pmcid, fingerprint of the result set, method, other scoring parameters)"""
+        return (pmcid, frame_fingerprint(df), method) + tuple(sorted(params.items()))
+
+    def _get(self, key):
+        if key in self._items:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return True, self._items[key]
+        return False, None
+
+    def get_or_compute(self, key, compute):
+        """
+        Cached value of the key, calling compute() on a miss.
+        Returns:
+            tuple: (value, computed) where computed is True only for the call that ran compute.
+        """
+        with self._lock:
+            found, value = self._get(key)
+            if found:
+                return value, False
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                found, value = self._get(key)
+                if found:
+                    return value, False
+            try:
+                value = compute()
+                with self._lock:
+                    self.misses += 1
+                    self._items[key] = value
+                    while len(self._items) > self.max_items:
+                        self._items.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+        return value, True
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+                'items': len(self._items),
+                'max_items': self.max_items}
+
+
+class ArticleStore:
+    """
+    SQLite store of raw BioC JSON payloads (zlib compressed) and parsed article dicts keyed by PMCID.
+    Entries older than ttl seconds count as misses unless the store is offline, and the least
+    recently accessed entries are evicted past max_items. Pinned entries (the bulk ingested
+    corpus, see put_many) never expire and are never evicted.
+    """
+    def __init__(self, path=None, ttl=30 * 24 * 3600, max_items=50000, offline=False):
+        self.path = path or os.path.join(CACHE_DIR, 'articles.sqlite')
+        self.ttl = ttl
+        self.max_items = max_items
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS articles (
+            pmcid TEXT PRIMARY KEY,
+            raw BLOB,
+            parsed TEXT,
+            raw_bytes INTEGER,
+            fetched_at REAL,
+            accessed_at REAL,
+            pinned INTEGER NOT NULL DEFAULT 0)
+        """)
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(articles)')]
+        if 'pinned' not in columns:
+            # Stores created before pinning existed
+            self._conn.execute('ALTER TABLE articles ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS articles_accessed ON articles (accessed_at)')
+        self._conn.commit()
+
+    @staticmethod
+    def normalize_id(pmcid):
+        pmcid = str(pmcid)
+        return pmcid[3:] if pmcid.upper().startswith('PMC') else pmcid
+
+    def _is_fresh(self, fetched_at, pinned=0):
+        return pinned or self.offline or not self.ttl or time.time() - fetched_at <= self.ttl
+
+    def get(self, pmcid):
+        """Parsed article dict of the PMCID, or None on a miss."""
+        key = self.normalize_id(pmcid)
+        with self._lock:
+            row = self._conn.execute('SELECT parsed, raw_bytes, fetched_at, pinned FROM articles WHERE pmcid = ?',
+                                     (key,)).fetchone()
+            if row is None or not self._is_fresh(row[2], row[3]):
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE articles SET accessed_at = ? WHERE pmcid = ?', (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            self.bytes_saved += row[1] or 0
+        return json.loads(row[0])
+
+    def peek(self, pmcid):
+        """Parsed article dict of the PMCID whatever its age, or None. Not counted in the stats."""
+        with self._lock:
+            row = self._conn.execute('SELECT parsed FROM articles WHERE pmcid = ?',
+                                     (self.normalize_id(pmcid),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_raw(self, pmcid):
+        """Raw BioC JSON payload of the PMCID, or None."""
+        with self._lock:
+            row = self._conn.execute('SELECT raw FROM articles WHERE pmcid = ?',
+                                     (self.normalize_id(pmcid),)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+    # A live write-through of a pinned article refreshes it but keeps it pinned
+    _UPSERT = """
+    INSERT INTO articles (pmcid, raw, parsed, raw_bytes, fetched_at, accessed_at, pinned)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(pmcid) DO UPDATE SET raw = excluded.raw, parsed = excluded.parsed, raw_bytes = excluded.raw_bytes,
+        fetched_at = excluded.fetched_at, accessed_at = excluded.accessed_at,
+        pinned = max(articles.pinned, excluded.pinned)
+    """
+
+    def _row(self, pmcid, raw, parsed, now, pinned):
+        raw_json = json.dumps(raw).encode('utf-8')
+        return (self.normalize_id(pmcid), zlib.compress(raw_json), json.dumps(parsed), len(raw_json), now, now,
+                int(pinned))
+
+    def put(self, pmcid, raw, parsed):
+        """Write through a fetched payload and its parsed article dict."""
+        with self._lock:
+            self._conn.execute(self._UPSERT, self._row(pmcid, raw, parsed, time.time(), False))
+            self._conn.commit()
+        self.evict()
+
+    def put_many(self, items, pinned=False):
+        """
+        Write many (pmcid, raw, parsed) tuples in a single transaction (bulk ingestion).
+        pinned rows are kept regardless of ttl and max_items, so the online cache policy of the app
+        (which opens the same file) cannot delete an offline corpus.
+        """
+        now = time.time()
+        rows = [self._row(pmcid, raw, parsed, now, pinned) for pmcid, raw, parsed in items]
+        with self._lock:
+            self._conn.executemany(self._UPSERT, rows)
+            self._conn.commit()
+        self.evict()
+
+    def __contains__(self, pmcid):
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM articles WHERE pmcid = ?',
+                                     (self.normalize_id(pmcid),)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM articles').fetchone()[0]
+
+    def iter_articles(self, fields=None, page_size=1000):
+        """
+        Yield every stored parsed article dict ({pmcid: info}), paging through the table by rowid so
+        only page_size articles are in memory at a time (the lock is held per page).
+        Parameters:
+            fields (list): Only extract these sections of info (done in SQLite), all of them if None.
+            page_size (int): Articles read per query.
+        """
+        paths = [f'$."{field}"' for field in fields] if fields is not None else []
+        columns = ''.join(f', json_extract(j.value, ?)' for _ in paths)
+        last_rowid = 0
+        while True:
+            with self._lock:
+                if fields is None:
+                    rows = self._conn.execute('SELECT rowid, parsed FROM articles WHERE rowid > ? '
+                                              'ORDER BY rowid LIMIT ?', (last_rowid, page_size)).fetchall()
+                else:
+                    rows = self._conn.execute(
+                        f'SELECT a.rowid, j.key{columns} FROM (SELECT rowid, parsed FROM articles WHERE rowid > ? '
+                        f'ORDER BY rowid LIMIT ?) AS a, json_each(a.parsed) AS j ORDER BY a.rowid',
+                        paths + [last_rowid, page_size]).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            for row in rows:
+                if fields is None:
+                    yield json.loads(row[1])
+                else:
+                    yield {row[1]: dict(zip(fields, row[2:]))}
+
+    def evict(self):
+        """Drop expired unpinned entries (unless offline) and the least recently used unpinned ones past max_items."""
+        with self._lock:
+            if self.ttl and not self.offline:
+                self._conn.execute('DELETE FROM articles WHERE pinned = 0 AND fetched_at < ?',
+                                   (time.time() - self.ttl,))
+            if self.max_items:
+                # max_items bounds the online cache only, pinned rows do not count
+                self._conn.execute("""
+                DELETE FROM articles WHERE pmcid IN (
+                    SELECT pmcid FROM articles WHERE pinned = 0 ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)
+                """, (self.max_items,))
+            self._conn.commit()
+
+    def stats(self):
+        """Hit rate and bytes of BioC payloads that did not have to be downloaded again."""
+        total = self.hits + self.misses
+        with self._lock:
+            items, raw_bytes, pinned = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(pinned), 0) FROM articles').fetchone()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+                'bytes_saved': self.bytes_saved,
+                'items': items,
+                'pinned': pinned,
+                'raw_bytes': raw_bytes,
+                'offline': self.offline}
+
+    def close(self):
+        self._conn.close()
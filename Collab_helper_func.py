@@ -0,0 +1,209 @@
+import time
+import argparse
+import numpy as np
+import scipy.sparse as sp
+
+############## Collaborative recommendations #################
+# Precomputes (Article)-[:SIMILAR_TO {score, co_selections}]->(Article) from the
+# (User)-[:SELECTED]->(Article) graph, so serving is a single indexed lookup.
+
+def export_selections(conn):
+    """Stream the user --> article selections out of Neo4j as a list of (user, pmcid)."""
+    query = """
+    MATCH (u:User)-[:SELECTED]->(a:Article)
+    RETURN DISTINCT u.username AS user, a.pmcid AS pmcid
+    """
+    return [(record['user'], record['pmcid']) for record in conn.stream(query)]
+
+
+def build_selection_matrix(selections):
+    """Sparse article x user matrix of the selections plus the article ids."""
+    articles = sorted({pmcid for _, pmcid in selections})
+    users = sorted({user for user, _ in selections})
+    article_idx = {pmcid: i for i, pmcid in enumerate(articles)}
+    user_idx = {user: i for i, user in enumerate(users)}
+    rows = [article_idx[pmcid] for _, pmcid in selections]
+    cols = [user_idx[user] for user, _ in selections]
+    matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(len(articles), len(users)))
+    matrix.data[:] = 1.0
+    return matrix, articles
+
+
+def co_selection_counts(matrix):
+    """Article x article number of users that selected both (diagonal removed)."""
+    co = (matrix @ matrix.T).tocsr()
+    co.setdiag(0)
+    co.eliminate_zeros()
+    return co
+
+
+def personalized_pagerank(matrix, alpha=0.85, iterations=20, batch_size=256):
+    """
+    Random walk with restart on the article - user - article graph, personalized on the SELECTED set of
+    every user. The walk applies the two sparse hops (article --> user --> article) in turn, so the
+    article x article transition matrix is never built.
+    Yields (user indices, dense batch x n_articles score matrix) batch by batch to bound memory.
+    """
+    n_users = matrix.shape[1]
+    # Row normalized hops: article --> user and user --> article
+    article_deg = np.asarray(matrix.sum(axis=1)).ravel()
+    user_deg = np.asarray(matrix.sum(axis=0)).ravel()
+    to_users = (sp.diags(1 / np.maximum(article_deg, 1)) @ matrix).tocsr()
+    to_articles = (sp.diags(1 / np.maximum(user_deg, 1)) @ matrix.T).tocsr()
+    for start in range(0, n_users, batch_size):
+        users = np.arange(start, min(start + batch_size, n_users))
+        # Restart uniformly on the user's selected articles
+        restart = to_articles[users].toarray()
+        scores = restart.copy()
+        for _ in range(iterations):
+            scores = (1 - alpha) * restart + alpha * ((scores @ to_users) @ to_articles)
+        yield users, scores
+
+
+def compute_similar_to(selections, top_n=20, alpha=0.85, iterations=20):
+    """
+    Top-n collaborative neighbours of every selected article. The score of source --> target is the
+    mean personalized PageRank of target over the users who selected source.
+    Returns:
+        list: Rows {'source', 'target', 'score', 'co_selections'} ready for write_similar_to.
+    """
+    if not selections:
+        return []
+    matrix, articles = build_selection_matrix(selections)
+    co = co_selection_counts(matrix)
+    # One accumulator per co-selected (source, target) pair, aligned with co.data
+    totals = np.zeros(len(co.data), dtype=np.float64)
+    selected_by = matrix.T.tocsr()
+    for users, scores in personalized_pagerank(matrix, alpha, iterations):
+        for user, user_scores in zip(users, scores):
+            for source in selected_by.indices[selected_by.indptr[user]:selected_by.indptr[user + 1]]:
+                pairs = slice(co.indptr[source], co.indptr[source + 1])
+                totals[pairs] += user_scores[co.indices[pairs]]
+    article_deg = np.diff(matrix.indptr)
+    rows = []
+    for source in range(len(articles)):
+        pairs = slice(co.indptr[source], co.indptr[source + 1])
+        # Only articles that were co-selected at least once are kept
+        candidates, counts = co.indices[pairs], co.data[pairs]
+        if not len(candidates):
+            continue
+        source_scores = totals[pairs] / max(article_deg[source], 1)
+        for j in np.argsort(-source_scores)[:top_n]:
+            rows.append({'source': articles[source],
+                         'target': articles[candidates[j]],
+                         'score': round(float(source_scores[j]), 6),
+                         'co_selections': int(counts[j])})
+    return rows
+
+
+def write_similar_to(conn, rows, batch_size=1000):
+    """
+    Replace the SIMILAR_TO relationships with the new rows (batched UNWIND): the old relationships of
+    each batch of sources are deleted right before its new ones are written, then the relationships of
+    sources that are no longer in the rows are swept.
+    """
+    delete_query = """
+    UNWIND $sources AS source
+    MATCH (a:Article {pmcid: source})-[s:SIMILAR_TO]->()
+    DELETE s
+    """
+    write_query = """
+    UNWIND $rows AS row
+    MATCH (a:Article {pmcid: row.source})
+    MATCH (b:Article {pmcid: row.target})
+    MERGE (a)-[s:SIMILAR_TO]->(b)
+    SET s.score = row.score, s.co_selections = row.co_selections, s.updated_at = $refreshed_at
+    """
+    sweep_query = """
+    MATCH ()-[s:SIMILAR_TO]->()
+    WHERE s.updated_at IS NULL OR s.updated_at < $refreshed_at
+    WITH s LIMIT $batch_size
+    DELETE s
+    RETURN count(*) AS deleted
+    """
+    refreshed_at = int(time.time() * 1000)
+    by_source = {}
+    for row in rows:
+        by_source.setdefault(row['source'], []).append(row)
+    sources = sorted(by_source)
+    for start in range(0, len(sources), batch_size):
+        batch = sources[start:start + batch_size]
+        conn.execute_write(delete_query, parameters={'sources': batch})
+        batch_rows = [row for source in batch for row in by_source[source]]
+        for offset in range(0, len(batch_rows), batch_size):
+            conn.execute_write(write_query, parameters={'rows': batch_rows[offset:offset + batch_size],
+                                                        'refreshed_at': refreshed_at})
+    # Sources without selections any more
+    while True:
+        result = conn.execute_write(sweep_query, parameters={'refreshed_at': refreshed_at,
+                                                             'batch_size': batch_size})
+        if not result or not result[0]['deleted']:
+            break
+
+
+def refresh_similar_to(conn, top_n=20, alpha=0.85, iterations=20):
+    """Batch job: recompute and materialize the collaborative SIMILAR_TO relationships."""
+    start = time.perf_counter()
+    selections = export_selections(conn)
+    rows = compute_similar_to(selections, top_n, alpha, iterations)
+    write_similar_to(conn, rows)
+    print(f"Wrote {len(rows)} SIMILAR_TO relationships from {len(selections)} selections "
+          f"in {time.perf_counter() - start:.1f}s")
+    return len(rows)
+
+
+def fetch_similar_to(conn, pmcid, k=50):
+    """Materialized collaborative neighbours of an article: {pmcid: score}."""
+    query = """
+    MATCH (:Article {pmcid: $pmcid})-[s:SIMILAR_TO]->(b:Article)
+    RETURN b.pmcid AS pmcid, s.score AS score
+    ORDER BY s.score DESC
+    LIMIT $k
+    """
+    try:
+        result = conn.execute_read(query, parameters={'pmcid': pmcid, 'k': k})
+        return {record['pmcid']: record['score'] for record in result}
+    except Exception as e:
+        print(f"Error occured while fetching similar articles: {e}")
+        return {}
+
+
+def fetch_user_suggestions(conn, user_name, k=10):
+    """Articles similar to the user's selections that the user has not selected yet."""
+    query = """
+    MATCH (u:User {username: $user_name})-[:SELECTED]->(:Article)-[s:SIMILAR_TO]->(b:Article)
+    WHERE NOT (u)-[:SELECTED]->(b)
+    RETURN b.pmcid AS pmcid, b.title AS title, sum(s.score) AS score, sum(s.co_selections) AS co_selections
+    ORDER BY score DESC
+    LIMIT $k
+    """
+    try:
+        return conn.execute_read(query, parameters={'user_name': user_name, 'k': k})
+    except Exception as e:
+        print(f"Error occured while fetching suggestions: {e}")
+        return []
+
+
+def main(argv=None):
+    from Neo4j_helper_func import Neo4jConnection
+    from secret_keys import neo4j_user, neo4j_passwd
+    parser = argparse.ArgumentParser(description="Materialize collaborative SIMILAR_TO relationships in Neo4j.")
+    parser.add_argument('--uri', default="neo4j://localhost:7687")
+    parser.add_argument('--top-n', type=int, default=20)
+    parser.add_argument('--alpha', type=float, default=0.85)
+    parser.add_argument('--interval', type=float, default=0, help="Repeat every N seconds (0 runs once)")
+    args = parser.parse_args(argv)
+
+    conn = Neo4jConnection(uri=args.uri, user=neo4j_user, pwd=neo4j_passwd)
+    try:
+        while True:
+            refresh_similar_to(conn, args.top_n, args.alpha)
+            if not args.interval:
+                break
+            time.sleep(args.interval)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,428 @@
+import os
+import threading
+import time
+import resource
+import argparse
+from types import SimpleNamespace
+import numpy as np
+from Cache_helper_func import CACHE_DIR
+
+DEFAULT_MODEL = 'bert-base-uncased'
+
+# Inference backend: 'torch' (fp32), 'torch-int8' (dynamically quantized Linear layers) or 'onnx' (ONNX Runtime)
+BACKENDS = ('torch', 'torch-int8', 'onnx')
+DEFAULT_BACKEND = os.environ.get('ENCODER_BACKEND', 'torch')
+# Intra-op CPU threads of the encoder (0 keeps the library default)
+ENCODER_THREADS = int(os.environ.get('ENCODER_THREADS', '0'))
+ONNX_DIR = os.environ.get('ONNX_DIR', os.path.join(CACHE_DIR, 'onnx'))
+
+# Process wide registry --> {(model_name, backend): {'tokenizer', 'model', 'load_time', 'rss_before_mb', 'rss_after_mb'}}
+_ENCODERS = {}
+_ENCODERS_LOCK = threading.Lock()
+
+
+def current_rss_mb():
+    """Resident memory of the current process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 ** 2)
+    except (OSError, ValueError, IndexError):
+        # Fallback (peak instead of current) for systems without /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def encoder_tag(model_name=DEFAULT_MODEL, backend=None):
+    """Model name used in embedding cache keys, so vectors of different backends are not mixed."""
+    backend = backend or DEFAULT_BACKEND
+    return model_name if backend == 'torch' else f'{model_name}@{backend}'
+
+
+class OnnxEncoder:
+    """ONNX Runtime session with the call signature and outputs of a Hugging Face model."""
+    def __init__(self, path, config, threads=ENCODER_THREADS):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.config = config
+
+    def __call__(self, **inputs):
+        import torch
+        feeds = {name: tensor.numpy() for name, tensor in inputs.items() if name in self.input_names}
+        # The exported graph always takes token_type_ids, the sliding window features do not build them
+        if 'token_type_ids' in self.input_names and 'token_type_ids' not in feeds:
+            feeds['token_type_ids'] = np.zeros_like(feeds['input_ids'])
+        last_hidden_state = self.session.run(['last_hidden_state'], feeds)[0]
+        return SimpleNamespace(last_hidden_state=torch.from_numpy(last_hidden_state))
+
+
+def export_onnx(model_name=DEFAULT_MODEL, onnx_dir=ONNX_DIR):
+    """Export the fp32 encoder to ONNX once (dynamic batch and sequence axes) and return the file path."""
+    import torch
+    from transformers import BertTokenizer, BertModel
+    path = os.path.join(onnx_dir, f"{model_name.replace('/', '_')}.onnx")
+    if os.path.exists(path):
+        return path
+    os.makedirs(onnx_dir, exist_ok=True)
+    tokenizer = BertTokenizer.from_pretrained(model_name)
+    model = BertModel.from_pretrained(model_name)
+    model.eval()
+    inputs = tokenizer(['export the encoder'], return_tensors='pt')
+    names = ['input_ids', 'attention_mask', 'token_type_ids']
+    axes = {0: 'batch', 1: 'sequence'}
+    # Tracing for export needs no_grad, inference tensors cannot be traced
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(inputs[name] for name in names), path + '.tmp', input_names=names,
+                          output_names=['last_hidden_state'],
+                          dynamic_axes={**{name: axes for name in names}, 'last_hidden_state': axes},
+                          opset_version=14)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def _load_backend(model_name, backend):
+    # Imported on first use, torch and transformers are slow to import
+    import torch
+    from transformers import BertTokenizer, BertModel
+    if ENCODER_THREADS:
+        torch.set_num_threads(ENCODER_THREADS)
+    tokenizer = BertTokenizer.from_pretrained(model_name)
+    if backend == 'onnx':
+        config = BertModel.config_class.from_pretrained(model_name)
+        return tokenizer, OnnxEncoder(export_onnx(model_name), config)
+    model = BertModel.from_pretrained(model_name)
+    model.eval()
+    if backend == 'torch-int8':
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return tokenizer, model
+
+
+def load_encoder(model_name=DEFAULT_MODEL, backend=None):
+    """
+    Load a tokenizer/model pair once per process and return it from the registry afterwards.
+    Parameters:
+        model_name (str): Name of the pretrained Hugging Face model.
+        backend (str): One of BACKENDS (DEFAULT_BACKEND when None).
+    Returns:
+        tuple: (tokenizer, model) with the model in eval mode.
+    """
+    backend = backend or DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend!r}, expected one of {BACKENDS}")
+    entry = _ENCODERS.get((model_name, backend))
+    if entry is None:
+        with _ENCODERS_LOCK:
+            # Another session might have loaded it while we waited for the lock
+            entry = _ENCODERS.get((model_name, backend))
+            if entry is None:
+                rss_before = current_rss_mb()
+                start = time.perf_counter()
+                tokenizer, model = _load_backend(model_name, backend)
+                entry = {'tokenizer': tokenizer,
+                         'model': model,
+                         'load_time': time.perf_counter() - start,
+                         'rss_before_mb': rss_before,
+                         'rss_after_mb': current_rss_mb()}
+                _ENCODERS[(model_name, backend)] = entry
+                print(f"Loaded {model_name} ({backend}) in {entry['load_time']:.2f}s "
+                      f"(RSS {entry['rss_before_mb']:.0f} -> {entry['rss_after_mb']:.0f} MB)")
+    return entry['tokenizer'], entry['model']
+
+
+def warm_up_encoder(model_name=DEFAULT_MODEL, backend=None):
+    """Load the encoder and run one dummy forward pass so the first real request is fast."""
+    import torch
+    tokenizer, model = load_encoder(model_name, backend)
+    with torch.inference_mode():
+        model(**tokenizer(['warm up'], return_tensors='pt'))
+    return get_encoder_stats(model_name, backend)
+
+
+def get_encoder_stats(model_name=DEFAULT_MODEL, backend=None):
+    """Load time and memory footprint of a registered encoder (None if not loaded yet)."""
+    backend = backend or DEFAULT_BACKEND
+    entry = _ENCODERS.get((model_name, backend))
+    if entry is None:
+        return None
+    return {'model_name': model_name,
+            'backend': backend,
+            'load_time_s': round(entry['load_time'], 3),
+            'rss_before_mb': round(entry['rss_before_mb'], 1),
+            'rss_after_mb': round(entry['rss_after_mb'], 1),
+            'model_rss_mb': round(entry['rss_after_mb'] - entry['rss_before_mb'], 1),
+            'current_rss_mb': round(current_rss_mb(), 1)}
+
+
+def make_batches(lengths, max_batch_size=16, max_tokens=4096):
+    """
+    Sort texts by token length and bucket them into micro-batches.
+    Parameters:
+        lengths (list): Token length of every text.
+        max_batch_size (int): Maximum number of texts per batch.
+        max_tokens (int): Budget of padded tokens (batch size x longest text) per batch.
+    Returns:
+        list: Batches of indices into lengths.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    current = []
+    current_max = 0
+    for i in order:
+        padded_max = max(current_max, lengths[i])
+        if current and (len(current) + 1 > max_batch_size or padded_max * (len(current) + 1) > max_tokens):
+            batches.append(current)
+            current = []
+            padded_max = lengths[i]
+        current.append(i)
+        current_max = padded_max
+    if current:
+        batches.append(current)
+    return batches
+
+
+def mean_pool(last_hidden_state, attention_mask):
+    """Mean over the real tokens only, so padding does not dilute the vectors."""
+    mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+    summed = (last_hidden_state * mask).sum(dim=1)
+    return summed / mask.sum(dim=1).clamp(min=1)
+
+
+# Throughput of the last encode_texts call
+_LAST_ENCODE_STATS = {}
+
+
+def get_encode_stats():
+    """Throughput (texts/s, tokens/s) and per batch memory of the last encode_texts call."""
+    return dict(_LAST_ENCODE_STATS)
+
+
+def _encode_batches(tokenizer, model, features, max_batch_size, max_tokens):
+    """Run the encoder over tokenized features in length bucketed micro-batches."""
+    import torch
+    lengths = [len(feature['input_ids']) for feature in features]
+    vectors = [None] * len(lengths)
+    batch_stats = []
+    with torch.inference_mode():
+        for batch in make_batches(lengths, max_batch_size, max_tokens):
+            batch_start = time.perf_counter()
+            inputs = tokenizer.pad([features[i] for i in batch], return_tensors='pt')
+            outputs = model(**inputs)
+            pooled = mean_pool(outputs.last_hidden_state, inputs['attention_mask']).numpy()
+            # Memory is sampled while the activations of the batch are still alive
+            batch_stats.append({'size': len(batch),
+                                'padded_length': int(inputs['input_ids'].shape[1]),
+                                'tokens': int(sum(lengths[i] for i in batch)),
+                                'seconds': round(time.perf_counter() - batch_start, 4),
+                                'rss_mb': round(current_rss_mb(), 1)})
+            for i, vector in zip(batch, pooled):
+                vectors[i] = vector
+    if not vectors:
+        return np.zeros((0, model.config.hidden_size), dtype=np.float32), batch_stats
+    return np.vstack(vectors), batch_stats
+
+
+def _record_stats(texts, tokens, batch_stats, elapsed, **extra):
+    global _LAST_ENCODE_STATS
+    _LAST_ENCODE_STATS = {'texts': texts,
+                          'tokens': tokens,
+                          'batches': len(batch_stats),
+                          'seconds': round(elapsed, 4),
+                          'texts_per_s': round(texts / elapsed, 2) if elapsed else 0.0,
+                          'tokens_per_s': round(tokens / elapsed, 2) if elapsed else 0.0,
+                          'peak_batch_rss_mb': max((b['rss_mb'] for b in batch_stats), default=0.0),
+                          **extra,
+                          'batch_stats': batch_stats}
+
+
+def encode_texts(texts_lst, model_name=DEFAULT_MODEL, max_batch_size=16, max_tokens=4096, max_length=512,
+                 backend=None):
+    """
+    Encode texts in length bucketed micro-batches with attention masked mean pooling.
+    Parameters:
+        texts_lst (list): Texts to encode.
+        model_name (str): Name of the pretrained encoder.
+        max_batch_size (int): Maximum number of texts per forward pass.
+        max_tokens (int): Maximum padded tokens per forward pass.
+        max_length (int): Texts are truncated to this many tokens (see encode_long_texts).
+        backend (str): Inference backend (DEFAULT_BACKEND when None).
+    Returns:
+        numpy.ndarray: One embedding per text, in input order.
+    """
+    tokenizer, model = load_encoder(model_name, backend)
+    start = time.perf_counter()
+    encodings = tokenizer(list(texts_lst), truncation=True, max_length=max_length)
+    features = [{key: encodings[key][i] for key in encodings.keys()} for i in range(len(encodings['input_ids']))]
+    vectors, batch_stats = _encode_batches(tokenizer, model, features, max_batch_size, max_tokens)
+    _record_stats(len(features), sum(len(f['input_ids']) for f in features), batch_stats,
+                  time.perf_counter() - start)
+    return vectors
+
+
+def sliding_windows(n_tokens, window=510, overlap=128, max_chunks=8):
+    """
+    (start, end) token spans of overlapping windows covering n_tokens. Past max_chunks windows,
+    max_chunks of them evenly spread over the document are kept so the cost per document is bounded.
+    """
+    step = max(window - overlap, 1)
+    starts = list(range(0, max(n_tokens - overlap, 1), step))
+    if max_chunks and len(starts) > max_chunks:
+        starts = [starts[i] for i in np.linspace(0, len(starts) - 1, max_chunks).round().astype(int)]
+    return [(start, min(start + window, n_tokens)) for start in starts]
+
+
+def encode_long_texts(texts_lst, model_name=DEFAULT_MODEL, window=510, overlap=128, max_chunks=8, pooling='mean',
+                      max_batch_size=16, max_tokens=4096, backend=None):
+    """
+    Encode texts of any length: every text is split into overlapping token windows, the windows of
+    all texts share the same micro-batches and are pooled back into one vector per text.
+    Parameters:
+        texts_lst (list): Texts to encode.
+        model_name (str): Name of the pretrained encoder.
+        window (int): Tokens per window, without the special tokens (510 fills BERT's 512).
+        overlap (int): Tokens shared by consecutive windows.
+        max_chunks (int): Maximum windows per text (None for no cap).
+        pooling (str): 'mean' or 'max' over the window vectors of a text.
+        max_batch_size (int): Maximum number of windows per forward pass.
+        max_tokens (int): Maximum padded tokens per forward pass.
+        backend (str): Inference backend (DEFAULT_BACKEND when None).
+    Returns:
+        numpy.ndarray: One embedding per text, in input order.
+    """
+    tokenizer, model = load_encoder(model_name, backend)
+    start = time.perf_counter()
+    # No truncation: the windows keep every forward pass within the model limit
+    token_ids = tokenizer(list(texts_lst), add_special_tokens=False)['input_ids']
+    features, owners = [], []
+    capped = 0
+    for i, ids in enumerate(token_ids):
+        spans = sliding_windows(len(ids), window, overlap, max_chunks)
+        capped += len(spans) < len(sliding_windows(len(ids), window, overlap, None))
+        for span_start, span_end in spans:
+            input_ids = tokenizer.build_inputs_with_special_tokens(ids[span_start:span_end])
+            features.append({'input_ids': input_ids, 'attention_mask': [1] * len(input_ids)})
+            owners.append(i)
+    window_vectors, batch_stats = _encode_batches(tokenizer, model, features, max_batch_size, max_tokens)
+
+    vectors = np.zeros((len(token_ids), model.config.hidden_size), dtype=np.float32)
+    if len(features):
+        owners = np.asarray(owners)
+        starts = np.flatnonzero(np.r_[True, np.diff(owners) != 0])
+        if pooling == 'max':
+            vectors[owners[starts]] = np.maximum.reduceat(window_vectors, starts, axis=0)
+        else:
+            counts = np.diff(np.r_[starts, len(owners)])
+            vectors[owners[starts]] = np.add.reduceat(window_vectors, starts, axis=0) / counts[:, None]
+    _record_stats(len(token_ids), sum(len(f['input_ids']) for f in features), batch_stats,
+                  time.perf_counter() - start, windows=len(features), capped_texts=int(capped))
+    return vectors
+
+
+############## Backend parity and benchmark #################
+SAMPLE_TEXTS = [
+    "Single-cell RNA sequencing reveals heterogeneity of tumor-infiltrating T cells in colorectal cancer.",
+    "We performed a randomized controlled trial of metformin in patients with type 2 diabetes.",
+    "CRISPR-Cas9 screening identifies regulators of mitochondrial metabolism in human cell lines.",
+    "Deep learning models predict protein structure from amino acid sequence with high accuracy.",
+    "The gut microbiome composition differs between patients with inflammatory bowel disease and controls.",
+    "Vaccine effectiveness against severe COVID-19 waned over six months after the second dose.",
+    "Amyloid beta accumulation precedes tau pathology in the preclinical stage of Alzheimer's disease.",
+    "Antibiotic resistance genes were detected in wastewater samples from urban hospitals.",
+]
+
+# Minimum cosine between a backend's vectors and the fp32 vectors of the same texts
+PARITY_THRESHOLDS = {'torch': 0.9999, 'onnx': 0.999, 'torch-int8': 0.98}
+
+
+def _unit(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def check_parity(backend, texts=SAMPLE_TEXTS, model_name=DEFAULT_MODEL, baseline='torch', threshold=None):
+    """
+    Compare the vectors of a backend with the fp32 baseline on the same texts, both through
+    encode_texts and through the sliding windows of encode_long_texts (small windows, so every
+    text spans several of them).
+    Returns:
+        dict: Per text cosine agreement (min/mean), largest error of the pairwise cosine similarity
+        matrix, whether every text's nearest neighbour is unchanged, the min agreement of the
+        windowed vectors, and passed.
+    """
+    threshold = PARITY_THRESHOLDS.get(backend, 0.98) if threshold is None else threshold
+    reference = _unit(encode_texts(texts, model_name, backend=baseline))
+    candidate = _unit(encode_texts(texts, model_name, backend=backend))
+    agreement = (reference * candidate).sum(axis=1)
+    long_reference = _unit(encode_long_texts(texts, model_name, window=8, overlap=2, backend=baseline))
+    long_candidate = _unit(encode_long_texts(texts, model_name, window=8, overlap=2, backend=backend))
+    long_agreement = (long_reference * long_candidate).sum(axis=1)
+    reference_sim = reference @ reference.T
+    candidate_sim = candidate @ candidate.T
+    np.fill_diagonal(reference_sim, -np.inf)
+    np.fill_diagonal(candidate_sim, -np.inf)
+    same_neighbours = bool((reference_sim.argmax(axis=1) == candidate_sim.argmax(axis=1)).all())
+    finite = np.isfinite(reference_sim)
+    return {'backend': backend,
+            'baseline': baseline,
+            'min_cosine': round(float(agreement.min()), 6),
+            'mean_cosine': round(float(agreement.mean()), 6),
+            'max_similarity_error': round(float(np.abs(reference_sim - candidate_sim)[finite].max()), 6),
+            'same_nearest_neighbours': same_neighbours,
+            'long_min_cosine': round(float(long_agreement.min()), 6),
+            'threshold': threshold,
+            'passed': bool(min(agreement.min(), long_agreement.min()) >= threshold)}
+
+
+def benchmark_backends(backends=BACKENDS, texts=SAMPLE_TEXTS, model_name=DEFAULT_MODEL, repeats=5, batch_size=16):
+    """
+    Load time, memory and encoding latency of every backend on the same texts, with the parity
+    against fp32. Backends whose dependencies are missing are reported with their error.
+    """
+    texts = list(texts) * max(1, batch_size // len(texts))
+    results = []
+    for backend in backends:
+        try:
+            warm_up_encoder(model_name, backend)
+            latencies = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                encode_texts(texts, model_name, max_batch_size=batch_size, backend=backend)
+                latencies.append(time.perf_counter() - start)
+            stats = get_encoder_stats(model_name, backend)
+            parity = check_parity(backend, model_name=model_name) if backend != 'torch' else None
+            results.append({'backend': backend,
+                            'load_time_s': stats['load_time_s'],
+                            'model_rss_mb': stats['model_rss_mb'],
+                            'median_ms': round(float(np.median(latencies)) * 1000, 1),
+                            'texts_per_s': round(len(texts) / float(np.median(latencies)), 1),
+                            'min_cosine': parity['min_cosine'] if parity else 1.0})
+        except Exception as e:
+            results.append({'backend': backend, 'error': str(e)})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parity check and benchmark of the encoder backends.")
+    parser.add_argument('command', choices=['parity', 'bench'])
+    parser.add_argument('--backend', nargs='+', default=[b for b in BACKENDS if b != 'torch'], choices=BACKENDS)
+    parser.add_argument('--model', default=DEFAULT_MODEL)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.command == 'parity':
+        failed = False
+        for backend in args.backend:
+            report = check_parity(backend, model_name=args.model)
+            print(report)
+            failed |= not report['passed']
+        # Non zero exit status when a backend drifts from fp32, usable as a CI gate
+        raise SystemExit(1 if failed else 0)
+    for row in benchmark_backends(['torch'] + [b for b in args.backend if b != 'torch'], model_name=args.model,
+                                  repeats=args.repeats):
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import os
+import json
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from Cache_helper_func import CACHE_DIR, atomic_write_json
+from spacy_helper_func import analyze_articles
+
+ENTITY_INDEX_PATH = os.path.join(CACHE_DIR, 'entity_index.json')
+SECTIONS = ('Title', 'Abstract', 'Introduction', 'Methods', 'Results', 'Discussion')
+
+
+def entity_key(text, label):
+    """Normalized identifier of an entity (case and whitespace insensitive)."""
+    return f"{label}|{' '.join(text.lower().split())}"
+
+
+def extract_mentions(article_df, sections=SECTIONS, n_process=2, batch_size=64):
+    """
+    Run NER over every section of every article with multiprocessing spaCy pipes.
+    Returns:
+        list: Mention rows {'pmcid', 'key', 'text', 'label', 'count', 'sections'}.
+    """
+    annotations = analyze_articles(article_df, sections, tasks=('entities',), n_process=n_process,
+                                   batch_size=batch_size)
+    mentions = {}
+    for (pmcid, section), result in annotations.items():
+        for text, label in result['entities']:
+            key = entity_key(text, label)
+            row = mentions.setdefault((pmcid, key), {'pmcid': pmcid, 'key': key, 'text': text, 'label': label,
+                                                     'count': 0, 'sections': []})
+            row['count'] += 1
+            if section not in row['sections']:
+                row['sections'].append(section)
+    return list(mentions.values())
+
+
+class EntityIndex:
+    """
+    Local inverted index entity --> {pmcid: count} (plus the forward pmcid --> entities map),
+    so entity filtering and entity overlap scoring are dictionary lookups.
+    """
+    def __init__(self, path=ENTITY_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.postings = defaultdict(dict)
+        self.articles = defaultdict(dict)
+        # Entity text --> keys of every label it was tagged with
+        self.by_text = defaultdict(set)
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            for key, docs in data.get('postings', {}).items():
+                self.postings[key] = docs
+                self.by_text[key.split('|', 1)[1]].add(key)
+            for pmcid, keys in data.get('articles', {}).items():
+                self.articles[pmcid] = keys
+
+    def __contains__(self, pmcid):
+        return pmcid in self.articles
+
+    def add(self, mentions, pmcids=()):
+        """Index mention rows, replacing the entities of articles indexed again (pmcids without mentions included)."""
+        by_article = defaultdict(dict, {pmcid: {} for pmcid in pmcids})
+        for row in mentions:
+            by_article[row['pmcid']][row['key']] = row['count']
+        with self._lock:
+            for pmcid, keys in by_article.items():
+                for old_key in self.articles.get(pmcid, {}):
+                    self.postings[old_key].pop(pmcid, None)
+                self.articles[pmcid] = keys
+                for key, count in keys.items():
+                    self.postings[key][pmcid] = count
+                    self.by_text[key.split('|', 1)[1]].add(key)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock:
+            atomic_write_json(self.path, {'postings': {key: docs for key, docs in self.postings.items() if docs},
+                                          'articles': self.articles})
+
+    def articles_with(self, text, label=None):
+        """PMCIDs mentioning the entity (any label when label is None), most mentions first."""
+        text = ' '.join(text.lower().split())
+        # Locked, a background ingestion may be adding to the postings
+        with self._lock:
+            if label is not None:
+                docs = dict(self.postings.get(entity_key(text, label), {}))
+            else:
+                docs = defaultdict(int)
+                for key in self.by_text.get(text, ()):
+                    for pmcid, count in self.postings[key].items():
+                        docs[pmcid] += count
+        return sorted(docs, key=docs.get, reverse=True)
+
+    def filter(self, pmcids, text, label=None):
+        """Keep only the pmcids that mention the entity."""
+        matching = set(self.articles_with(text, label))
+        return [pmcid for pmcid in pmcids if pmcid in matching]
+
+    def overlap_scores(self, pmcid, pmcids):
+        """Weighted Jaccard overlap of the entities of pmcid with those of every candidate."""
+        query = self.articles.get(pmcid, {})
+        scores = np.zeros(len(pmcids), dtype=np.float32)
+        if not query:
+            return scores
+        for i, other in enumerate(pmcids):
+            entities = self.articles.get(other, {})
+            shared = query.keys() & entities.keys()
+            if not shared:
+                continue
+            inter = sum(min(query[key], entities[key]) for key in shared)
+            union = sum(query.values()) + sum(entities.values()) - inter
+            scores[i] = inter / union
+        return scores
+
+
+def write_mentions(conn, mentions, article_df=None, batch_size=1000):
+    """
+    Store the mentions as (:Document)-[:MENTIONS {count, sections}]->(:Entity) with batched UNWIND writes.
+    Fetched articles get their own Document label so they do not become (:Article) nodes, which are the
+    selected articles (see SELECTED_QUERY and get_statistics); both share the pmcid to join on.
+    """
+    titles = dict(zip(article_df['pmcid'], article_df['Title'])) if article_df is not None else {}
+    query = """
+    UNWIND $rows AS row
+    MERGE (d:Document {pmcid: row.pmcid})
+    ON CREATE SET d.title = row.title, d.created_at = timestamp()
+    MERGE (e:Entity {key: row.key})
+    ON CREATE SET e.text = row.text, e.label = row.label
+    MERGE (d)-[m:MENTIONS]->(e)
+    SET m.count = row.count, m.sections = row.sections
+    """
+    rows = [dict(row, title=titles.get(row['pmcid'], '')) for row in mentions]
+    for start in range(0, len(rows), batch_size):
+        conn.execute_write(query, parameters={'rows': rows[start:start + batch_size]})
+
+
+def ingest_entities(article_df, conn=None, index=None, n_process=2, batch_size=64, sections=SECTIONS):
+    """
+    Ingestion stage after run_script: extract the entities of the articles that are not indexed yet,
+    add them to the local inverted index and write them to Neo4j.
+    Returns:
+        int: Number of mention rows written.
+    """
+    if index is not None:
+        article_df = article_df[~article_df['pmcid'].isin(list(index.articles))]
+    if article_df.empty:
+        return 0
+    mentions = extract_mentions(article_df, sections, n_process, batch_size)
+    if index is not None:
+        index.add(mentions, article_df['pmcid'])
+        index.save()
+    if conn is not None:
+        try:
+            write_mentions(conn, mentions, article_df)
+        except Exception as e:
+            print("Error writing entity mentions:", e)
+    return len(mentions)
+
+
+class EntityIngestor:
+    """
+    Runs ingest_entities on one background thread, so the Streamlit script thread never waits for
+    spaCy. n_process defaults to 1: forking the server process while the Neo4j driver and the other
+    worker threads run risks deadlocks (multiprocess pipes are for the offline path).
+    """
+    def __init__(self, conn, index, n_process=1, batch_size=64):
+        self.conn = conn
+        self.index = index
+        self.n_process = n_process
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='entity-ingest')
+        self._lock = threading.Lock()
+        self._metrics = {'submitted': 0, 'completed': 0, 'failed': 0, 'mentions': 0}
+
+    def _run(self, article_df):
+        try:
+            mentions = ingest_entities(article_df, self.conn, self.index, self.n_process, self.batch_size)
+            with self._lock:
+                self._metrics['completed'] += 1
+                self._metrics['mentions'] += mentions
+        except Exception as e:
+            print("Entity ingestion failed:", e)
+            with self._lock:
+                self._metrics['failed'] += 1
+
+    def submit(self, article_df):
+        """Queue the articles for ingestion (a copy is taken, the caller may keep changing its frame)."""
+        with self._lock:
+            self._metrics['submitted'] += 1
+        return self._executor.submit(self._run, article_df.copy())
+
+    def stats(self):
+        with self._lock:
+            return dict(self._metrics)
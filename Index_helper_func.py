@@ -0,0 +1,693 @@
+import os
+import sys
+import json
+import time
+import pickle
+import weakref
+import threading
+import argparse
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+from Cache_helper_func import CACHE_DIR, ArticleStore, STORAGE_MODES, quantize
+
+# Optional ANN libraries, the NumPy brute force search is used without them
+try:
+    import faiss
+except ImportError:
+    faiss = None
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+INDEX_DIR = os.path.join(CACHE_DIR, 'vector_index')
+TFIDF_PATH = os.path.join(CACHE_DIR, 'tfidf.pkl')
+
+
+def normalize(vectors):
+    """L2 normalize the rows so inner product equals cosine similarity."""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first, without a full sort."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+class VectorIndex:
+    """
+    Nearest neighbour index over normalized article embeddings.
+    backend is 'faiss' (HNSW), 'hnswlib', 'numpy' (exact brute force) or 'auto' (best one installed).
+    storage 'float16' or 'int8' (per vector scale) searches compact vectors (faiss: scalar quantized HNSW)
+    and rescores the top k x rescore candidates exactly with the float32 vectors, which are then only
+    memory mapped from a file in vectors_dir (default INDEX_DIR) instead of held in RAM.
+    Vectors and ids are kept on disk next to the ANN index so it can be rebuilt or extended.
+    """
+    def __init__(self, dim=768, backend='auto', M=32, ef_construction=200, ef_search=64, storage='float32',
+                 rescore=4, vectors_dir=None):
+        if backend == 'auto':
+            backend = 'faiss' if faiss is not None else 'hnswlib' if hnswlib is not None else 'numpy'
+        if backend == 'faiss' and faiss is None or backend == 'hnswlib' and hnswlib is None:
+            raise ImportError(f"Backend {backend} is not installed")
+        if storage not in STORAGE_MODES:
+            raise ValueError(f"Unknown storage {storage!r}, expected one of {list(STORAGE_MODES)}")
+        if backend == 'hnswlib' and storage != 'float32':
+            raise ValueError("hnswlib only stores float32 vectors, use the faiss or numpy backend")
+        self.dim = dim
+        self.backend = backend
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.storage = storage
+        self.rescore = rescore
+        self.vectors_dir = vectors_dir or INDEX_DIR
+        self._vectors_path = None
+        self.ids = []
+        self._id_set = set()
+        # Exact float32 vectors (memory mapped in compact modes, only the rescored rows are read)
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        # Compact copy scanned by the numpy backend
+        self.codes = np.zeros((0, dim), dtype=STORAGE_MODES[storage][0])
+        self.scales = np.zeros(0, dtype=np.float32) if storage == 'int8' else None
+        self._ann = None
+        self._init_ann()
+
+    def _init_ann(self, capacity=1024):
+        if self.backend == 'faiss':
+            if self.storage == 'float32':
+                self._ann = faiss.IndexHNSWFlat(self.dim, self.M, faiss.METRIC_INNER_PRODUCT)
+            else:
+                qtype = faiss.ScalarQuantizer.QT_fp16 if self.storage == 'float16' else faiss.ScalarQuantizer.QT_8bit
+                self._ann = faiss.IndexHNSWSQ(self.dim, qtype, self.M, faiss.METRIC_INNER_PRODUCT)
+            self._ann.hnsw.efConstruction = self.ef_construction
+            self._ann.hnsw.efSearch = self.ef_search
+        elif self.backend == 'hnswlib':
+            self._ann = hnswlib.Index(space='ip', dim=self.dim)
+            self._ann.init_index(max_elements=capacity, M=self.M, ef_construction=self.ef_construction)
+            self._ann.set_ef(self.ef_search)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self._id_set
+
+    def add(self, ids, vectors):
+        """Incrementally add vectors, ids already in the index are skipped."""
+        vectors = normalize(vectors)
+        keep = [i for i, id in enumerate(ids) if id not in self._id_set]
+        if not keep:
+            return 0
+        new_ids = [ids[i] for i in keep]
+        new_vectors = vectors[keep]
+        start = len(self.ids)
+        if self.backend == 'faiss':
+            if not self._ann.is_trained:
+                # The 8 bit scalar quantizer learns its value ranges from the first vectors added
+                self._ann.train(new_vectors)
+            self._ann.add(new_vectors)
+        elif self.backend == 'hnswlib':
+            needed = start + len(new_ids)
+            if needed > self._ann.get_max_elements():
+                self._ann.resize_index(max(needed, 2 * self._ann.get_max_elements()))
+            self._ann.add_items(new_vectors, np.arange(start, needed))
+        if self.backend == 'numpy' and self.storage != 'float32':
+            codes, scales = quantize(new_vectors, self.storage)
+            self.codes = np.vstack([self.codes, codes])
+            if scales is not None:
+                self.scales = np.concatenate([self.scales, scales])
+        self._append_vectors(new_vectors)
+        self.ids.extend(new_ids)
+        self._id_set.update(new_ids)
+        return len(new_ids)
+
+    def _append_vectors(self, new_vectors, chunk_size=65536):
+        if self.storage == 'float32':
+            self.vectors = np.vstack([self.vectors, new_vectors])
+            return
+        # Compact modes only read the float32 rows of the rescored candidates, so they are appended
+        # to a file owned by the index and memory mapped read only
+        blocks = [new_vectors]
+        if self._vectors_path is None:
+            os.makedirs(self.vectors_dir, exist_ok=True)
+            fd, self._vectors_path = tempfile.mkstemp(prefix='rescore-', suffix='.f32', dir=self.vectors_dir)
+            os.close(fd)
+            weakref.finalize(self, _remove_file, self._vectors_path)
+            # Rows of a loaded index are copied once so the file can be extended
+            blocks.insert(0, self.vectors)
+        with open(self._vectors_path, 'ab') as f:
+            for rows in blocks:
+                for start in range(0, len(rows), chunk_size):
+                    f.write(np.ascontiguousarray(rows[start:start + chunk_size], dtype=np.float32).tobytes())
+        n_rows = os.path.getsize(self._vectors_path) // (4 * self.dim)
+        self.vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r', shape=(n_rows, self.dim))
+
+    def nbytes(self):
+        """Bytes of the vectors scanned at search time (the float32 ones when storage is float32)."""
+        if self.storage == 'float32':
+            return int(self.vectors.nbytes)
+        return int(self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0))
+
+    def footprint(self):
+        """
+        Memory and disk use of the vector arrays (the ANN graph of faiss/hnswlib is not included).
+        Returns:
+            dict: scanned_bytes (nbytes), resident_bytes (scanned plus arrays held in RAM) and
+            disk_bytes (files the arrays are memory mapped from).
+        """
+        resident = self.nbytes()
+        if self.storage != 'float32' and not isinstance(self.vectors, np.memmap):
+            resident += self.vectors.nbytes
+        arrays = (self.vectors, self.codes, self.scales)
+        disk = sum(os.path.getsize(a.filename) for a in arrays
+                   if isinstance(a, np.memmap) and a.filename and os.path.exists(a.filename))
+        return {'scanned_bytes': self.nbytes(), 'resident_bytes': int(resident), 'disk_bytes': int(disk)}
+
+    def search_compact(self, query, k=10, chunk_size=65536):
+        """Approximate top-k over the compact vectors, scanned in chunks to bound the float32 temporaries."""
+        query = normalize(query)[0]
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        for start in range(0, len(self.ids), chunk_size):
+            chunk = np.asarray(self.codes[start:start + chunk_size], dtype=np.float32) @ query
+            if self.scales is not None:
+                chunk *= self.scales[start:start + chunk_size]
+            scores[start:start + chunk_size] = chunk
+        idx = top_k(scores, k)
+        return idx, scores[idx]
+
+    def _rescore(self, query, idx, k):
+        # Exact cosine of the candidates from the float32 vectors (sorted rows read the memory map in order)
+        idx = np.sort(np.asarray(idx))
+        scores = np.asarray(self.vectors[idx]) @ normalize(query)[0]
+        best = top_k(scores, k)
+        return [self.ids[i] for i in idx[best]], scores[best]
+
+    def search_exact(self, query, k=10):
+        """Brute force cosine top-k (also the ground truth of the benchmark)."""
+        scores = self.vectors @ normalize(query)[0]
+        idx = top_k(scores, k)
+        return [self.ids[i] for i in idx], scores[idx]
+
+    def search(self, query, k=10):
+        """
+        Top-k most similar articles.
+        Parameters:
+            query (numpy.ndarray): Query embedding (normalized internally).
+            k (int): Number of neighbours.
+        Returns:
+            tuple: (list of ids, numpy array of cosine similarities), best first.
+        """
+        if not self.ids:
+            return [], np.array([], dtype=np.float32)
+        k = min(k, len(self.ids))
+        compact = self.storage != 'float32'
+        n_candidates = min(k * self.rescore, len(self.ids)) if compact and self.rescore else k
+        if self.backend == 'numpy':
+            if not compact:
+                return self.search_exact(query, k)
+            idx, scores = self.search_compact(query, n_candidates)
+        else:
+            query = normalize(query)
+            if self.backend == 'faiss':
+                scores, idx = self._ann.search(query, n_candidates)
+                scores, idx = scores[0], idx[0]
+            else:
+                idx, distances = self._ann.knn_query(query, k=n_candidates)
+                # hnswlib returns 1 - inner product for the 'ip' space
+                idx, scores = idx[0], 1 - distances[0]
+            valid = idx >= 0
+            idx, scores = idx[valid], scores[valid]
+        if compact and self.rescore:
+            return self._rescore(query, idx, k)
+        return [self.ids[i] for i in idx[:k]], scores[:k]
+
+    def save(self, index_dir=INDEX_DIR):
+        os.makedirs(index_dir, exist_ok=True)
+        # Written aside first, self.vectors may be a memory map of the saved file
+        np.save(os.path.join(index_dir, 'vectors.tmp.npy'), self.vectors)
+        os.replace(os.path.join(index_dir, 'vectors.tmp.npy'), os.path.join(index_dir, 'vectors.npy'))
+        if self.backend == 'numpy' and self.storage != 'float32':
+            np.save(os.path.join(index_dir, 'codes.npy'), self.codes)
+            if self.scales is not None:
+                np.save(os.path.join(index_dir, 'scales.npy'), self.scales)
+        with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+            json.dump({'dim': self.dim, 'backend': self.backend, 'M': self.M,
+                       'ef_construction': self.ef_construction, 'ef_search': self.ef_search,
+                       'storage': self.storage, 'rescore': self.rescore, 'ids': self.ids}, f)
+        if self.backend == 'faiss':
+            faiss.write_index(self._ann, os.path.join(index_dir, 'ann.faiss'))
+        elif self.backend == 'hnswlib':
+            self._ann.save_index(os.path.join(index_dir, 'ann.hnsw'))
+
+    @classmethod
+    def load(cls, index_dir=INDEX_DIR, backend=None, storage=None):
+        """Load a saved index, rebuilding the ANN structure or compact vectors if the backend or storage changed."""
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        saved_storage = meta.get('storage', 'float32')
+        index = cls(dim=meta['dim'], backend=backend or meta['backend'], M=meta['M'],
+                    ef_construction=meta['ef_construction'], ef_search=meta['ef_search'],
+                    storage=storage or saved_storage, rescore=meta.get('rescore', 4), vectors_dir=index_dir)
+        vectors = np.load(os.path.join(index_dir, 'vectors.npy'), mmap_mode='r')
+        if index.backend == meta['backend'] and index.storage == saved_storage:
+            if index.backend == 'faiss':
+                index._ann = faiss.read_index(os.path.join(index_dir, 'ann.faiss'))
+                index._ann.hnsw.efSearch = index.ef_search
+            elif index.backend == 'hnswlib':
+                index._ann.load_index(os.path.join(index_dir, 'ann.hnsw'), max_elements=len(meta['ids']))
+                index._ann.set_ef(index.ef_search)
+            elif index.storage != 'float32':
+                index.codes = np.load(os.path.join(index_dir, 'codes.npy'), mmap_mode='r')
+                if index.storage == 'int8':
+                    index.scales = np.load(os.path.join(index_dir, 'scales.npy'), mmap_mode='r')
+            index.vectors = vectors
+            index.ids = meta['ids']
+            index._id_set = set(index.ids)
+        else:
+            index.add(meta['ids'], vectors)
+        return index
+
+
+class TfidfIndex:
+    """
+    TF-IDF model fitted once on the cached corpus and kept as a sparse, L2 normalized document matrix.
+    New documents are transformed with the fitted vocabulary (partial update); needs_refit tells when
+    enough of them were added that the vocabulary/idf should be refitted.
+    add and score hold a lock so one instance can be shared by the app sessions; save only holds it
+    to snapshot the index and schedule_save pickles it later on a timer thread.
+    """
+    def __init__(self, max_features=200000, min_df=1, refit_ratio=0.2):
+        self.max_features = max_features
+        self.min_df = min_df
+        self.refit_ratio = refit_ratio
+        self.vectorizer = None
+        self.ids = []
+        self._rows = {}
+        self.matrix = sp.csr_matrix((0, 0), dtype=np.float32)
+        self.fitted_docs = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('_lock', '_save_lock', '_save_timer'):
+            state.pop(name, None)
+        # add appends to ids and _rows in place (the matrix and vectorizer are replaced, not mutated)
+        state['ids'] = list(self.ids)
+        state['_rows'] = dict(self._rows)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self._rows
+
+    def fit(self, ids, texts):
+        """Fit the vocabulary and idf on the corpus and index all of it."""
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        self.vectorizer = TfidfVectorizer(stop_words='english', max_features=self.max_features,
+                                          min_df=self.min_df, dtype=np.float32)
+        self.matrix = self.vectorizer.fit_transform(texts).tocsr()
+        self.ids = list(ids)
+        self._rows = {id: row for row, id in enumerate(self.ids)}
+        self.fitted_docs = len(self.ids)
+        return self
+
+    @property
+    def needs_refit(self):
+        return self.vectorizer is None or len(self.ids) - self.fitted_docs > self.refit_ratio * max(self.fitted_docs, 1)
+
+    def transform(self, texts):
+        """Sparse TF-IDF rows of the texts using the fitted vocabulary."""
+        return self.vectorizer.transform(texts)
+
+    def add(self, ids, texts):
+        """Index new documents without refitting, existing ids are skipped."""
+        with self._lock:
+            keep = [i for i, id in enumerate(ids) if id not in self._rows]
+            if not keep:
+                return 0
+            if self.vectorizer is None:
+                self.fit([ids[i] for i in keep], [texts[i] for i in keep])
+                return len(keep)
+            new_rows = self.transform([texts[i] for i in keep])
+            self.matrix = sp.vstack([self.matrix, new_rows], format='csr')
+            for i in keep:
+                self._rows[ids[i]] = len(self.ids)
+                self.ids.append(ids[i])
+            return len(keep)
+
+    def score(self, query_text, ids=None):
+        """Cosine similarity of the query to the indexed documents (or only to ids) as a dense 1-D array."""
+        query = self.transform([query_text])
+        with self._lock:
+            matrix = self.matrix if ids is None else self.matrix[[self._rows[id] for id in ids]]
+        # Rows are L2 normalized, so the sparse dot product is the cosine similarity
+        return np.asarray((matrix @ query.T).todense()).ravel()
+
+    def search(self, query_text, k=10, exclude=None):
+        """Top-k (ids, scores) for the query text, best first."""
+        scores = self.score(query_text)
+        exclude = set(exclude or [])
+        idx = top_k(scores, k + len(exclude))
+        idx = [i for i in idx if self.ids[i] not in exclude][:k]
+        return [self.ids[i] for i in idx], scores[idx]
+
+    def save(self, path=TFIDF_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Consistent snapshot under the lock, pickled without it so scoring is not blocked
+        with self._lock:
+            snapshot = TfidfIndex.__new__(TfidfIndex)
+            snapshot.__dict__.update(self.__getstate__())
+        # Written aside and renamed so a reader never loads a partial pickle
+        with self._save_lock:
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(snapshot, f)
+            os.replace(path + '.tmp', path)
+
+    def schedule_save(self, path=TFIDF_PATH, delay=30.0):
+        """Save in a background timer thread after delay seconds, additions until then share one save."""
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(delay, self._timed_save, args=(path,))
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _timed_save(self, path):
+        with self._lock:
+            self._save_timer = None
+        try:
+            self.save(path)
+        except Exception as e:
+            print(f"Saving the TF-IDF index failed: {e}")
+
+    @staticmethod
+    def load(path=TFIDF_PATH):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a sparse term count matrix. The per document term weights are precomputed,
+    so scoring a query is one sparse matrix-vector product.
+    """
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.vectorizer = None
+        self.ids = []
+        self._rows = {}
+        self.counts = None
+        self.weights = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self._rows
+
+    def fit(self, ids, texts):
+        from sklearn.feature_extraction.text import CountVectorizer
+        self.vectorizer = CountVectorizer(stop_words='english', dtype=np.float32)
+        self.counts = self.vectorizer.fit_transform(texts).tocsr()
+        self.ids = list(ids)
+        self._rows = {id: row for row, id in enumerate(self.ids)}
+        self._compute_weights()
+        return self
+
+    def add(self, ids, texts):
+        """Index new documents with the fitted vocabulary, existing ids are skipped."""
+        keep = [i for i, id in enumerate(ids) if id not in self._rows]
+        if not keep:
+            return 0
+        if self.vectorizer is None:
+            self.fit([ids[i] for i in keep], [texts[i] for i in keep])
+            return len(keep)
+        for i in keep:
+            self._rows[ids[i]] = len(self.ids)
+            self.ids.append(ids[i])
+        self.counts = sp.vstack([self.counts, self.vectorizer.transform([texts[i] for i in keep])], format='csr')
+        # Document frequencies and the average length changed
+        self._compute_weights()
+        return len(keep)
+
+    def _compute_weights(self):
+        n_docs = self.counts.shape[0]
+        doc_len = np.asarray(self.counts.sum(axis=1)).ravel()
+        avg_len = doc_len.mean() if n_docs else 1.0
+        df = np.bincount(self.counts.indices, minlength=self.counts.shape[1])
+        idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        weights = self.counts.copy()
+        tf = weights.data
+        # Length normalization of every stored (doc, term) entry
+        row_len = np.repeat(doc_len, np.diff(weights.indptr))
+        norm = self.k1 * (1 - self.b + self.b * row_len / max(avg_len, 1e-9))
+        weights.data = (tf * (self.k1 + 1) / (tf + norm) * idf[weights.indices]).astype(np.float32)
+        self.weights = weights
+
+    def score(self, query_text, ids=None):
+        """BM25 score of the query for the indexed documents (or only for ids)."""
+        query = self.vectorizer.transform([query_text])
+        weights = self.weights if ids is None else self.weights[[self._rows[id] for id in ids]]
+        return np.asarray((weights @ query.T).todense()).ravel()
+
+    def search(self, query_text, k=10, exclude=None):
+        """Top-k (ids, scores) for the query text, best first."""
+        scores = self.score(query_text)
+        exclude = set(exclude or [])
+        idx = top_k(scores, k + len(exclude))
+        idx = [i for i in idx if self.ids[i] not in exclude][:k]
+        return [self.ids[i] for i in idx], scores[idx]
+
+
+def build_tfidf(store, index=None, section='Abstract'):
+    """Fit (or partially update) the TF-IDF index on the articles of the store."""
+    ids, texts = [], []
+    for pmcid, _, text in iter_store_texts(store, section):
+        ids.append(pmcid)
+        texts.append(text)
+    if index is None:
+        index = TfidfIndex()
+    index.add(ids, texts)
+    if index.needs_refit:
+        print(f"Refitting TF-IDF vocabulary on {len(ids)} articles")
+        index.fit(ids, texts)
+    return index
+
+
+def iter_store_texts(store, section='Abstract'):
+    """Yield (pmcid, title, text) of every article in the store with a non empty section."""
+    for article_data in store.iter_articles(fields=('Title', section)):
+        for pmcid, info in article_data.items():
+            text = info.get(section)
+            if text:
+                pmcid = 'PMC' + str(pmcid) if not str(pmcid).startswith('PMC') else pmcid
+                yield pmcid, info.get('Title', ''), text
+
+
+def import_bioc_dir(path, store, batch_size=500):
+    """
+    Parse a local PMC OA BioC dump (JSON/XML files, directories or tarballs) into the article store as
+    pinned rows, one article per BioC document (same parser as Ingest_helper_func).
+    """
+    from Ingest_helper_func import iter_sources, parse_source
+    imported = 0
+    items = []
+    for name, payload in iter_sources([path]):
+        _, _, raws = parse_source(name, payload, keep_raw=True)
+        items.extend(raws)
+        if len(items) >= batch_size:
+            store.put_many(items, pinned=True)
+            imported += len(items)
+            items = []
+    if items:
+        store.put_many(items, pinned=True)
+        imported += len(items)
+    print(f"Imported {imported} articles from {path}")
+    return imported
+
+
+def build_index(store, index=None, section='Abstract', chunk_size=256, cache=None):
+    """
+    Encode the articles of the store that are not in the index yet and add them.
+    Parameters:
+        store (ArticleStore): Source of parsed articles.
+        index (VectorIndex): Index to extend (a new one is created if None).
+        section (str): Article section to embed.
+        chunk_size (int): Number of articles encoded per step (bounds memory).
+        cache (EmbeddingCache): Optional embedding cache to reuse vectors from.
+    Returns:
+        VectorIndex: The extended index.
+    """
+    start = time.perf_counter()
+    added = 0
+    pmcids, texts = [], []
+    for pmcid, _, text in iter_store_texts(store, section):
+        if index is not None and pmcid in index:
+            continue
+        pmcids.append(pmcid)
+        texts.append(text)
+        if len(pmcids) >= chunk_size:
+            index, added = _add_chunk(index, pmcids, texts, section, cache), added + len(pmcids)
+            pmcids, texts = [], []
+    if pmcids:
+        index, added = _add_chunk(index, pmcids, texts, section, cache), added + len(pmcids)
+    elapsed = time.perf_counter() - start
+    print(f"Added {added} articles in {elapsed:.1f}s ({added / elapsed if elapsed else 0:.1f} articles/s), "
+          f"index size {len(index) if index is not None else 0}")
+    return index
+
+
+def _add_chunk(index, pmcids, texts, section, cache):
+    from Recommend_helper_func import vectorize_text, vectorize_cached
+    if cache is not None:
+        vectors = vectorize_cached(texts, pmcids, cache, section)
+    else:
+        vectors = vectorize_text(texts, 'bert')
+    if index is None:
+        index = VectorIndex(dim=vectors.shape[1])
+    index.add(pmcids, vectors)
+    return index
+
+
+def benchmark_index(index, n_queries=100, k=10, seed=0):
+    """
+    Recall@k of the ANN search against exact search and query latency.
+    Queries are sampled from the indexed vectors.
+    """
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(index), size=min(n_queries, len(index)), replace=False)
+    latencies = []
+    recalls = []
+    for i in queries:
+        query = np.asarray(index.vectors[i])
+        start = time.perf_counter()
+        found, _ = index.search(query, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        exact, _ = index.search_exact(query, k)
+        recalls.append(len(set(found) & set(exact)) / len(exact))
+    latencies = np.array(latencies)
+    return {'backend': index.backend,
+            'size': len(index),
+            'k': k,
+            'queries': len(queries),
+            f'recall@{k}': round(float(np.mean(recalls)), 4),
+            'mean_ms': round(float(latencies.mean()), 3),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 3)}
+
+
+def benchmark_storage(vectors, ids=None, modes=('float32', 'float16', 'int8'), k=10, n_queries=100, rescore=4,
+                      seed=0):
+    """
+    Memory footprint and recall loss of the compact storage modes (numpy backend) against exact float32
+    search, without and with exact rescoring of the top k x rescore candidates. bytes are the scanned
+    vectors, resident_bytes everything held in RAM and disk_bytes the memory mapped rescoring vectors.
+    Returns:
+        list: One row per storage mode.
+    """
+    vectors = normalize(vectors)
+    ids = list(ids) if ids is not None else list(range(len(vectors)))
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)]
+    exact = VectorIndex(dim=vectors.shape[1], backend='numpy')
+    exact.add(ids, vectors)
+    truth = [set(exact.search_exact(query, k)[0]) for query in queries]
+    results = []
+    for storage in modes:
+        index = VectorIndex(dim=vectors.shape[1], backend='numpy', storage=storage, rescore=rescore)
+        index.add(ids, vectors)
+        footprint = index.footprint()
+        row = {'storage': storage, 'size': len(index), 'bytes': index.nbytes(),
+               'bytes_per_vector': round(index.nbytes() / max(len(index), 1), 1),
+               'resident_bytes': footprint['resident_bytes'], 'disk_bytes': footprint['disk_bytes']}
+        for label, factor in (('compact', 0), ('rescored', rescore)):
+            index.rescore = factor
+            latencies, recalls = [], []
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                found, _ = index.search(query, k)
+                latencies.append((time.perf_counter() - start) * 1000)
+                recalls.append(len(set(found) & expected) / len(expected))
+            row[f'recall@{k}_{label}'] = round(float(np.mean(recalls)), 4)
+            row[f'mean_ms_{label}'] = round(float(np.mean(latencies)), 3)
+            if storage == 'float32':
+                break
+        results.append(row)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and benchmark the article vector index.")
+    parser.add_argument('command', choices=['build', 'bench', 'tfidf', 'storage'])
+    parser.add_argument('--store', default=None, help="Path of the article store (SQLite)")
+    parser.add_argument('--bioc-dir', default=None,
+                        help="Local BioC dump (JSON/XML files, directory or tarball) to import into the store first")
+    parser.add_argument('--index-dir', default=INDEX_DIR)
+    parser.add_argument('--tfidf-path', default=TFIDF_PATH)
+    parser.add_argument('--backend', default='auto', choices=['auto', 'faiss', 'hnswlib', 'numpy'])
+    parser.add_argument('--storage', default=None, choices=list(STORAGE_MODES),
+                        help="Precision of the searched vectors (default: float32, or the saved index's)")
+    parser.add_argument('--section', default='Abstract')
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    exists = os.path.exists(os.path.join(args.index_dir, 'meta.json'))
+    if args.command == 'build':
+        backend = None if args.backend == 'auto' else args.backend
+        index = VectorIndex.load(args.index_dir, backend, args.storage) if exists else None
+        if index is None and (backend or args.storage):
+            index = VectorIndex(backend=backend or 'auto', storage=args.storage or 'float32',
+                                vectors_dir=args.index_dir)
+        store = ArticleStore(args.store, offline=True, max_items=None)
+        if args.bioc_dir:
+            import_bioc_dir(args.bioc_dir, store)
+        index = build_index(store, index, args.section, args.chunk_size)
+        if index is not None:
+            index.save(args.index_dir)
+    elif args.command == 'tfidf':
+        store = ArticleStore(args.store, offline=True, max_items=None)
+        if args.bioc_dir:
+            import_bioc_dir(args.bioc_dir, store)
+        tfidf = TfidfIndex.load(args.tfidf_path) if os.path.exists(args.tfidf_path) else None
+        tfidf = build_tfidf(store, tfidf, args.section)
+        tfidf.save(args.tfidf_path)
+        print(f"TF-IDF index with {len(tfidf)} articles and {tfidf.matrix.shape[1]} terms")
+    else:
+        if not exists:
+            sys.exit(f"No index found in {args.index_dir}")
+        if args.command == 'storage':
+            vectors = np.load(os.path.join(args.index_dir, 'vectors.npy'), mmap_mode='r')
+            print(json.dumps(benchmark_storage(vectors, k=args.k, n_queries=args.queries), indent=2))
+            return
+        index = VectorIndex.load(args.index_dir, None if args.backend == 'auto' else args.backend, args.storage)
+        print(json.dumps(benchmark_index(index, args.queries, args.k), indent=2))
+
+
+if __name__ == '__main__':
+    main()
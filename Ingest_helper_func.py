@@ -0,0 +1,253 @@
+import os
+import io
+import gzip
+import json
+import time
+import tarfile
+import argparse
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+from API_helper_func import parse_article_info
+from Cache_helper_func import CACHE_DIR, atomic_write_json
+
+############## Offline bulk ingestion #################
+# Streams local PMC OA BioC dumps (JSON or XML files, directories or tarballs) through
+# parse_article_info with a process pool and writes the sections to chunked Parquet files.
+# A manifest of the finished sources lets an interrupted run resume where it stopped.
+
+COLUMNS = ['pmcid', 'PMID', 'Title', 'Abstract', 'Introduction', 'Methods', 'Results', 'Discussion', 'DOI', 'source']
+BIOC_SUFFIXES = ('.json', '.xml', '.json.gz', '.xml.gz')
+MANIFEST = 'manifest.json'
+
+
+def is_bioc_file(name):
+    return name.lower().endswith(BIOC_SUFFIXES)
+
+
+def iter_sources(paths):
+    """
+    Yield (name, payload bytes) of every BioC file under the paths, reading tarballs as a stream
+    so only one member is in memory at a time.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    full_path = os.path.join(root, name)
+                    if is_bioc_file(name):
+                        with open(full_path, 'rb') as f:
+                            yield full_path, f.read()
+                    elif tarfile.is_tarfile(full_path):
+                        yield from iter_sources([full_path])
+        elif tarfile.is_tarfile(path):
+            with tarfile.open(path, 'r|*') as tar:
+                for member in tar:
+                    if member.isfile() and is_bioc_file(member.name):
+                        yield f"{path}:{member.name}", tar.extractfile(member).read()
+        elif is_bioc_file(path):
+            with open(path, 'rb') as f:
+                yield path, f.read()
+        else:
+            print(f"Skipping {path}: not a BioC file, directory or tarball")
+
+
+def bioc_xml_to_json(payload):
+    """Convert a BioC XML collection to the BioC JSON structure parse_article_info expects."""
+    root = ET.parse(io.BytesIO(payload)).getroot()
+    documents = []
+    for document in root.iter('document'):
+        passages = []
+        for passage in document.iter('passage'):
+            passages.append({'infons': {infon.get('key'): infon.text or '' for infon in passage.findall('infon')},
+                             'offset': int(passage.findtext('offset') or 0),
+                             'text': passage.findtext('text') or ''})
+        documents.append({'id': document.findtext('id'), 'passages': passages})
+    return [{'documents': documents}]
+
+
+def load_bioc(name, payload):
+    """BioC JSON collections (list of collections) of a JSON or XML payload, gzip compressed or not."""
+    if name.lower().endswith('.gz'):
+        payload = gzip.decompress(payload)
+        name = name[:-3]
+    if name.lower().endswith('.xml'):
+        return bioc_xml_to_json(payload)
+    data = json.loads(payload)
+    return data if isinstance(data, list) else [data]
+
+
+def parse_source(name, payload, keep_raw=False):
+    """
+    Worker: parse every document of one BioC file separately (dumps may bundle many articles per file).
+    Returns:
+        tuple: (name, rows, raws) where rows are COLUMNS dicts and raws (pmcid, raw, parsed) tuples
+        for the article store (only when keep_raw).
+    """
+    rows, raws = [], []
+    try:
+        collections = load_bioc(name, payload)
+    except Exception as e:
+        print(f"Skipping {name}: {e}")
+        return name, rows, raws
+    for collection in collections:
+        for document in collection.get('documents', []):
+            raw = [dict(collection, documents=[document])]
+            try:
+                article_data = parse_article_info(raw)
+            except Exception:
+                # Documents without article ids
+                continue
+            for pmcid, info in article_data.items():
+                pmcid = 'PMC' + str(pmcid) if not str(pmcid).startswith('PMC') else pmcid
+                rows.append(dict(info, pmcid=pmcid, source=name))
+                if keep_raw:
+                    raws.append((pmcid, raw, {pmcid: info}))
+    return name, rows, raws
+
+
+class ParquetChunkWriter:
+    """
+    Buffers article rows and writes them as part-NNNNN.parquet files of chunk_size rows.
+    A source is recorded as finished in the manifest only once all its rows are on disk.
+    """
+    def __init__(self, out_dir, chunk_size=5000):
+        self.out_dir = out_dir
+        self.chunk_size = chunk_size
+        self.manifest_path = os.path.join(out_dir, MANIFEST)
+        os.makedirs(out_dir, exist_ok=True)
+        self.manifest = {'parts': [], 'sources': [], 'articles': 0}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        self.done = set(self.manifest['sources'])
+        self._rows = []
+        self._sources = []
+
+    def add(self, name, rows):
+        self._rows.extend(rows)
+        self._sources.append(name)
+        if len(self._rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            name = f"part-{len(self.manifest['parts']):05d}.parquet"
+            path = os.path.join(self.out_dir, name)
+            df = pd.DataFrame(self._rows, columns=COLUMNS)
+            # A part left over by an interrupted run is simply overwritten
+            df.to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+            self.manifest['parts'].append(name)
+            self.manifest['articles'] += len(df)
+        if self._sources:
+            self.manifest['sources'].extend(self._sources)
+            self.done.update(self._sources)
+            atomic_write_json(self.manifest_path, self.manifest)
+        self._rows = []
+        self._sources = []
+
+
+def ingest(paths, out_dir, workers=4, chunk_size=5000, store=None, report_every=10.0):
+    """
+    Ingest local BioC dumps into chunked Parquet files (and optionally the article store).
+    Parameters:
+        paths (list): BioC files, directories or tarballs.
+        out_dir (str): Output directory of the Parquet parts and the manifest.
+        workers (int): Parser processes (0 parses in this process).
+        chunk_size (int): Articles per Parquet part (bounds memory).
+        store (ArticleStore): Optional article store to write the parsed articles through.
+        report_every (float): Seconds between progress reports.
+    Returns:
+        dict: Number of articles, sources parsed and skipped, elapsed seconds and articles/s.
+    """
+    writer = ParquetChunkWriter(out_dir, chunk_size)
+    keep_raw = store is not None
+    stats = {'articles': 0, 'sources': 0, 'skipped': 0}
+    start = last_report = time.perf_counter()
+
+    def collect(name, rows, raws):
+        nonlocal last_report
+        writer.add(name, rows)
+        if raws:
+            store.put_many(raws, pinned=True)
+        stats['articles'] += len(rows)
+        stats['sources'] += 1
+        now = time.perf_counter()
+        if now - last_report >= report_every:
+            last_report = now
+            print(f"{stats['articles']} articles from {stats['sources']} files, "
+                  f"{stats['articles'] / (now - start):.0f} articles/s")
+
+    def sources():
+        for name, payload in iter_sources(paths):
+            if name in writer.done:
+                stats['skipped'] += 1
+                continue
+            yield name, payload
+
+    try:
+        if workers <= 0:
+            for name, payload in sources():
+                collect(*parse_source(name, payload, keep_raw))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # Bounded number of payloads in flight instead of reading the whole dump ahead
+                pending = set()
+                for name, payload in sources():
+                    pending.add(executor.submit(parse_source, name, payload, keep_raw))
+                    if len(pending) >= workers * 4:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            collect(*future.result())
+                for future in pending:
+                    collect(*future.result())
+    finally:
+        # Whatever was parsed before an interruption is kept
+        writer.flush()
+
+    stats['elapsed_s'] = round(time.perf_counter() - start, 2)
+    stats['articles_per_s'] = round(stats['articles'] / stats['elapsed_s'], 1) if stats['elapsed_s'] else 0.0
+    return stats
+
+
+def read_articles(out_dir, columns=None):
+    """Load the ingested articles as one DataFrame (columns limits what is read from disk)."""
+    with open(os.path.join(out_dir, MANIFEST)) as f:
+        parts = json.load(f)['parts']
+    if not parts:
+        return pd.DataFrame(columns=columns or COLUMNS)
+    return pd.concat([pd.read_parquet(os.path.join(out_dir, part), columns=columns) for part in parts],
+                     ignore_index=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest local PMC OA BioC dumps (no network) into Parquet.")
+    parser.add_argument('paths', nargs='+', help="BioC JSON/XML files, directories or tarballs")
+    parser.add_argument('--out', default=os.path.join(CACHE_DIR, 'articles_parquet'))
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--store', action='store_true',
+                        help="Also write the articles to the local article store (pinned, never evicted)")
+    args = parser.parse_args(argv)
+
+    store = None
+    if args.store:
+        from Cache_helper_func import ArticleStore
+        # Ingested rows are pinned, the app's ttl and max_items never delete them
+        store = ArticleStore()
+    try:
+        stats = ingest(args.paths, args.out, args.workers, args.chunk_size, store)
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to resume.")
+        return
+    finally:
+        if store is not None:
+            store.close()
+    print(f"Ingested {stats['articles']} articles from {stats['sources']} files "
+          f"({stats['skipped']} already done) in {stats['elapsed_s']}s, {stats['articles_per_s']} articles/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,60 +1,181 @@
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, READ_ACCESS, WRITE_ACCESS
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
+from collections import OrderedDict
+from enum import Enum
+import atexit
+import queue
+import random
+import threading
+import time
 import bcrypt
+import numpy as np
 import streamlit as st
-import matplotlib.pyplot as plt
-import plotly.graph_objects as go
 
 class Neo4jConnection:
-    def __init__(self, uri, user, pwd):
+    def __init__(self, uri, user, pwd, database=None, max_connection_pool_size=50,
+                 connection_acquisition_timeout=30.0, timing=False, slow_query_ms=500):
         self.__uri = uri
         self.__user = user
         self.__pwd = pwd
         self.__driver = None
+        self.database = database
+        # Per query timing and slow query log
+        self.timing = timing
+        self.slow_query_ms = slow_query_ms
+        self.query_stats = {'queries': 0, 'total_ms': 0.0, 'slow_queries': 0}
+        # Queries run on the script threads, the write-behind worker and the entity ingestion thread
+        self._stats_lock = threading.Lock()
         try:
-            self.__driver = GraphDatabase.driver(self.__uri, auth=(self.__user, self.__pwd))
+            self.__driver = GraphDatabase.driver(self.__uri, auth=(self.__user, self.__pwd),
+                                                 max_connection_pool_size=max_connection_pool_size,
+                                                 connection_acquisition_timeout=connection_acquisition_timeout)
         except Exception as e:
             print("Failed to create the driver:", e)
     
     def close(self):
         if self.__driver:
             self.__driver.close()
+
+    def _session(self, access_mode=WRITE_ACCESS):
+        assert self.__driver is not None, "Driver not initialized!"
+        return self.__driver.session(database=self.database, default_access_mode=access_mode)
+
+    def _record_timing(self, query, start):
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        slow = self.slow_query_ms is not None and elapsed_ms >= self.slow_query_ms
+        with self._stats_lock:
+            self.query_stats['queries'] += 1
+            self.query_stats['total_ms'] += elapsed_ms
+            self.query_stats['slow_queries'] += int(slow)
+        if slow:
+            print(f"Slow query ({elapsed_ms:.0f} ms): {' '.join(query.split())[:200]}")
+        elif self.timing:
+            print(f"Query ({elapsed_ms:.1f} ms): {' '.join(query.split())[:200]}")
     
+    def get_query_stats(self):
+        """Copy of the query count, total time and slow query count."""
+        with self._stats_lock:
+            return dict(self.query_stats)
+
     def query(self, query, parameters=None):
+        """Legacy auto-commit query, returns None on errors (prefer execute_read/execute_write)."""
         assert self.__driver is not None, "Driver not initialized!"
         session = None
         response = None
+        start = time.perf_counter()
         try:
-            session = self.__driver.session()
+            session = self._session()
             response = list(session.run(query, parameters))
         except Exception as e:
             print("Query failed:", e)
         finally:
             if session:
                 session.close()
+            self._record_timing(query, start)
         return response
-    
+
+    def execute_read(self, query, parameters=None):
+        """Run a read query in a managed transaction (routed to readers in a cluster) and return its records."""
+        start = time.perf_counter()
+        try:
+            with self._session(READ_ACCESS) as session:
+                return session.execute_read(lambda tx: list(tx.run(query, parameters)))
+        finally:
+            self._record_timing(query, start)
+
+    def execute_write(self, query, parameters=None):
+        """Run a write query in a managed (retried) transaction and return its records."""
+        start = time.perf_counter()
+        try:
+            with self._session(WRITE_ACCESS) as session:
+                return session.execute_write(lambda tx: list(tx.run(query, parameters)))
+        finally:
+            self._record_timing(query, start)
+
+    def stream(self, query, parameters=None, fetch_size=1000):
+        """Yield the records of a large read lazily, fetch_size records per round trip."""
+        start = time.perf_counter()
+        with self.__driver.session(database=self.database, default_access_mode=READ_ACCESS,
+                                   fetch_size=fetch_size) as session:
+            try:
+                for record in session.run(query, parameters):
+                    yield record
+            finally:
+                self._record_timing(query, start)
+
+########### Schema #############
+SCHEMA_QUERIES = [
+    """
+    CREATE CONSTRAINT user_unique_username IF NOT EXISTS
+    FOR (u:User) REQUIRE u.username IS UNIQUE
+    """,
+    """
+    CREATE CONSTRAINT article_pmcid IF NOT EXISTS
+    FOR (a:Article) REQUIRE a.pmcid IS UNIQUE
+    """,
+    """
+    CREATE CONSTRAINT recom_article_id IF NOT EXISTS
+    FOR (r:RecomArticle) REQUIRE r.article_id IS UNIQUE
+    """,
+    """
+    CREATE CONSTRAINT entity_key IF NOT EXISTS
+    FOR (e:Entity) REQUIRE e.key IS UNIQUE
+    """,
+    """
+    CREATE CONSTRAINT document_pmcid IF NOT EXISTS
+    FOR (d:Document) REQUIRE d.pmcid IS UNIQUE
+    """,
+]
+
+def ensure_schema(conn):
+    """
+    Create the constraints (and their backing indexes) once, at startup.
+    Returns:
+        bool: True if every constraint was created (or already existed).
+    """
+    created = True
+    for query in SCHEMA_QUERIES:
+        try:
+            conn.execute_write(query)
+        except Exception as e:
+            print("Constraint setup failed:", e)
+            created = False
+    return created
+
 ########### User Authentication #############
+class RegistrationResult(Enum):
+    CREATED = 'created'
+    EXISTS = 'exists'          # same username, first and last name
+    TAKEN = 'taken'            # username belongs to someone else
+
 def register_user(conn, first, last, username, password):
-    """Register a new user in Neo4j."""
+    """
+    Register a new user in Neo4j if the username is free.
+    A single MERGE backed by the unique username constraint (see ensure_schema),
+    so the check and the creation are atomic and do not scan the users.
+    Returns:
+        RegistrationResult
+    """
     hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-    try:
-        conn.query("""
-        CREATE CONSTRAINT user_unique_username IF NOT EXISTS
-        FOR (u:User) REQUIRE u.username IS UNIQUE;
-        """)
-    except Exception as e:
-        print("Constraint setup failed:", e)
-
     query = """
-    CREATE (u:User {first_name:$first, last_name: $last, username: $username, password: $password})
+    MERGE (u:User {username: $username})
+    ON CREATE SET u.first_name = $first, u.last_name = $last, u.password = $password, u._created = true
+    WITH u, coalesce(u._created, false) AS created
+    REMOVE u._created
+    RETURN created, u.first_name AS first_name, u.last_name AS last_name
     """
-    conn.query(query, parameters={"username": username, "password": hashed_pw, 'first': first, 'last': last})
-    return True
+    result = conn.execute_write(query, parameters={"username": username, "password": hashed_pw, 'first': first, 'last': last})
+    record = result[0]
+    if record['created']:
+        return RegistrationResult.CREATED
+    if record['first_name'] == first and record['last_name'] == last:
+        return RegistrationResult.EXISTS
+    return RegistrationResult.TAKEN
 
 def fetch_users(conn):
     """Fetch all user information"""
     query = "MATCH (u:User) RETURN u.first_name AS first_name, u.last_name as last_name, u.username AS user_name"
-    results = conn.query(query)
+    results = conn.execute_read(query)
     user_info = {}
     for items in results:
         first_name = items['first_name']
@@ -70,82 +191,270 @@ def verify_user(conn, username, password):
     MATCH (u:User {username: $username})
     RETURN u.password AS password
     """
-    result = conn.query(query, parameters={"username": username})
+    result = conn.execute_read(query, parameters={"username": username})
     if result:
         stored_password = result[0]["password"]
         return bcrypt.checkpw(password.encode('utf-8'), stored_password.encode('utf-8'))
     return False
 
-def add_selected(conn, selected, user, keyword):
-    """Add user seletced article to database"""
+SELECTED_QUERY = """
+UNWIND $rows AS row
+MERGE (a:Article {pmcid: row.article_id})
+ON CREATE SET a.created_at = timestamp()
+// Also on match, the node may have been created without them (e.g. by an older entity ingest)
+SET a.title = row.title, a.abstract = row.abstract
+WITH a, row
+MATCH (u:User {username: row.user_name})
+MERGE (u)-[r:SELECTED {keyword: row.keyword}]->(a)
+ON CREATE SET r.created_at = timestamp()
+"""
+
+RECOMMENDED_QUERY = """
+UNWIND $groups AS g
+UNWIND g.rows AS row
+MERGE (r:RecomArticle {article_id: row.article_id})
+ON CREATE SET r.title = row.title, r.abstract = row.abstract, r.similarity_score = row.similarity
+WITH g, r
+MATCH (u:User {username: g.user_name})-[:SELECTED]->(a:Article {pmcid: g.selected_id})
+WITH DISTINCT a, r
+MERGE (a)-[:RECOMMENDED]->(r)
+"""
+
+# Decayed average of the selected article embeddings, updated in place (O(dim) per selection).
+# Rows must be one per user (see fold_profile_rows): every row of the UNWIND reads the profile
+# before any of them is written. row.initial is the profile to start from when there is none yet.
+PROFILE_QUERY = """
+UNWIND $rows AS row
+MATCH (u:User {username: row.user_name})
+WITH u, row, coalesce(u.profile, []) AS old
+SET u.profile = CASE WHEN size(old) = size(row.vector)
+                     THEN [i IN range(0, size(old) - 1) | row.decay * old[i] + (1 - row.decay) * row.vector[i]]
+                     ELSE row.initial END,
+    u.profile_count = coalesce(u.profile_count, 0) + row.count,
+    u.profile_updated_at = timestamp()
+"""
+
+PROFILE_DECAY = 0.8
+
+def profile_row(user, vector, decay=PROFILE_DECAY):
+    vector = np.asarray(vector, dtype=np.float64)
+    vector = (vector / max(np.linalg.norm(vector), 1e-12)).round(6).tolist()
+    return {'user_name': user, 'vector': vector, 'decay': decay, 'initial': vector, 'count': 1}
+
+def fold_profile_rows(row, new):
+    """
+    Combine two profile updates of the same user, in submission order, into one row with the same effect:
+    d2 * (d1 * p + (1 - d1) * v1) + (1 - d2) * v2 = D * p + (1 - D) * V with D = d1 * d2.
+    """
+    d1, d2 = row['decay'], new['decay']
+    v1, v2 = np.asarray(row['vector']), np.asarray(new['vector'])
+    decay = d1 * d2
+    vector = (d2 * (1 - d1) * v1 + (1 - d2) * v2) / max(1 - decay, 1e-12)
+    initial = d2 * np.asarray(row['initial']) + (1 - d2) * v2
+    return {'user_name': row['user_name'], 'vector': vector.round(6).tolist(), 'decay': decay,
+            'initial': initial.round(6).tolist(), 'count': row['count'] + new['count']}
+
+def update_user_profile(conn, user, vector, decay=PROFILE_DECAY):
+    """Fold the embedding of a newly selected article into the user's profile vector."""
     try:
-        conn.query("""
-        CREATE CONSTRAINT article_id IF NOT EXISTS
-        FOR (a:Article) REQUIRE a.article_id IS UNIQUE;
-        """)
+        conn.execute_write(PROFILE_QUERY, parameters={'rows': [profile_row(user, vector, decay)]})
     except Exception as e:
-        print("Constraint setup failed:", e)
+        print("Error updating user profile:", e)
 
-    # Adding selected article
-    article_id = selected['pmcid']
-    title = selected['Title']
-    abstract = selected['Abstract']
-    query = f"""
-    MERGE (a:Article {{pmcid: $article_id}})
-    ON CREATE SET a.title = $title, a.abstract = $abstract, a.created_at = timestamp()
-    WITH a
-    MATCH (u:User {{username: $user_name}})
-    MERGE (u)-[r:SELECTED {{keyword:$keyword}}]->(a)
-    ON CREATE SET r.created_at = timestamp()
-    """
-    # Run the query
+def fetch_user_profile(conn, user_name):
+    """Profile vector of the user (numpy array) or None if the user has not selected anything yet."""
+    query = """
+    MATCH (u:User {username: $user_name})
+    RETURN u.profile AS profile
+    """
     try:
-        conn.query(query, parameters={
-            'article_id': article_id,
-            'title': title,
-            'abstract': abstract,
+        result = conn.execute_read(query, parameters={'user_name': user_name})
+    except Exception as e:
+        print(f"Error occured while fetching profile: {e}")
+        return None
+    if result and result[0]['profile']:
+        return np.asarray(result[0]['profile'], dtype=np.float32)
+    return None
+
+def selected_row(selected, user, keyword):
+    return {'article_id': selected['pmcid'],
+            'title': selected['Title'],
+            'abstract': selected['Abstract'],
             'user_name': user,
-            'keyword':keyword
-        })
+            'keyword': keyword}
+
+def recommended_group(recommended, selected, user):
+    return {'user_name': user,
+            'selected_id': selected['pmcid'],
+            'rows': [{'article_id': item.pmcid,
+                      'title': item.title,
+                      'abstract': item.abstract,
+                      'similarity': round(item.similarity_score, 4)} for item in recommended]}
+
+def add_selected(conn, selected, user, keyword):
+    """Add user seletced article to database"""
+    try:
+        conn.execute_write(SELECTED_QUERY, parameters={'rows': [selected_row(selected, user, keyword)]})
     except Exception as e:
         print("Error adding article or relationship:", e)
 
 def add_recommended(conn, recommended, selected, user):
     """Add recommended articles for the user 
        seletced article to database"""
+    group = recommended_group(recommended, selected, user)
+    if not group['rows']:
+        return
+    # One round trip for the whole recommendation set
     try:
-        conn.query("""
-        CREATE CONSTRAINT article_id IF NOT EXISTS
-        FOR (r:RecomArticle) REQUIRE r.article_id IS UNIQUE;
-        """)
+        conn.execute_write(RECOMMENDED_QUERY, parameters={'groups': [group]})
     except Exception as e:
-        print("Constraint setup failed:", e)
-    selected_id  = selected['pmcid']
-    for id, item in recommended.items():
-        article_id = id
-        similarity = round(item['similarity_score'], 4)
-        title = item['title']
-        abstract = item['abstract']
-
-        query = f"""
-        MERGE (r:RecomArticle {{article_id: $article_id}})
-        ON CREATE SET r.title = $title, r.abstract = $abstract, r.similarity_score = $similarity
-        WITH r
-        MATCH (u:User {{username: $user_name}})-[:SELECTED]->(a:Article {{pmcid: $selected_id}})
-        MERGE (a)-[:RECOMMENDED]->(r)
-        """
-        # Run the query
+        print("Error adding article or relationship:", e)
+
+
+class InteractionWriter:
+    """
+    Write-behind queue for SELECTED/RECOMMENDED events. The Streamlit thread only enqueues;
+    a worker thread coalesces duplicate events and flushes them in batches when batch_size
+    events are pending or flush_interval seconds have passed, retrying transient errors.
+    """
+    TRANSIENT_ERRORS = (ServiceUnavailable, SessionExpired, TransientError)
+
+    def __init__(self, conn, max_queue=1000, batch_size=50, flush_interval=1.0, max_retries=3, backoff=0.5):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = OrderedDict()
+        self._pending_since = None
+        self._stop = threading.Event()
+        self._metrics = {'enqueued': 0, 'coalesced': 0, 'dropped': 0, 'flushed': 0, 'failed': 0,
+                         'flushes': 0, 'last_flush_ms': 0.0, 'total_flush_ms': 0.0}
+        # The metrics are updated from the submitting threads and the worker
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name='neo4j-write-behind', daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._metrics[name] += n
+
+    def _submit(self, key, kind, payload):
         try:
-            conn.query(query, parameters={
-                'article_id': article_id,
-                'title': title,
-                'abstract': abstract,
-                'user_name': user,
-                'similarity':similarity,
-                'selected_id':selected_id
-            })
-        except Exception as e:
-            print("Error adding article or relationship:", e)
+            self._queue.put((key, kind, payload), timeout=0.1)
+            self._count('enqueued')
+        except queue.Full:
+            self._count('dropped')
+            print("Write-behind queue full, dropping event", key)
+
+    def submit_selected(self, selected, user, keyword):
+        row = selected_row(selected, user, keyword)
+        self._submit(('selected', user, row['article_id'], keyword), 'selected', row)
+
+    def submit_recommended(self, recommended, selected, user):
+        group = recommended_group(recommended, selected, user)
+        if group['rows']:
+            self._submit(('recommended', user, group['selected_id']), 'recommended', group)
+
+    def submit_profile(self, user, vector, decay=PROFILE_DECAY):
+        """
+        Fold a selection into the user's profile. vector is the selection's embedding or a zero argument
+        callable returning it, which is then called on the worker thread (e.g. to encode on a cache miss).
+        """
+        # One pending profile event per user, later selections are folded into it
+        self._submit(('profile', user), 'profile', (vector, decay))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                key, kind, payload = self._queue.get(timeout=self.flush_interval / 4)
+                self._add_pending(key, kind, payload)
+            except queue.Empty:
+                pass
+            due = self._pending_since is not None and time.monotonic() - self._pending_since >= self.flush_interval
+            if len(self._pending) >= self.batch_size or due:
+                self._flush()
+        # Drain what is left on shutdown
+        while True:
+            try:
+                self._add_pending(*self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._flush()
+
+    def _add_pending(self, key, kind, payload):
+        if kind == 'profile':
+            vector, decay = payload
+            try:
+                payload = profile_row(key[1], vector() if callable(vector) else vector, decay)
+            except Exception as e:
+                print("Profile vector failed:", e)
+                self._count('failed')
+                return
+        if key in self._pending:
+            self._count('coalesced')
+        elif not self._pending:
+            self._pending_since = time.monotonic()
+        if kind == 'profile' and key in self._pending:
+            # Profile updates do not replace each other, they are applied in order
+            payload = fold_profile_rows(self._pending[key][1], payload)
+        # The latest event wins, but keeps its original position
+        self._pending[key] = (kind, payload)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        events = list(self._pending.values())
+        self._pending = OrderedDict()
+        self._pending_since = None
+        rows = [payload for kind, payload in events if kind == 'selected']
+        groups = [payload for kind, payload in events if kind == 'recommended']
+        profiles = [payload for kind, payload in events if kind == 'profile']
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                # SELECTED first, the RECOMMENDED query matches on those relationships
+                if rows:
+                    self.conn.execute_write(SELECTED_QUERY, parameters={'rows': rows})
+                    rows = []
+                if groups:
+                    self.conn.execute_write(RECOMMENDED_QUERY, parameters={'groups': groups})
+                    groups = []
+                if profiles:
+                    self.conn.execute_write(PROFILE_QUERY, parameters={'rows': profiles})
+                self._count('flushed', len(events))
+                break
+            except self.TRANSIENT_ERRORS as e:
+                if attempt == self.max_retries:
+                    print("Write-behind flush failed:", e)
+                    self._count('failed', len(events))
+                    break
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            except Exception as e:
+                print("Write-behind flush failed:", e)
+                self._count('failed', len(events))
+                break
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._metrics['flushes'] += 1
+            self._metrics['last_flush_ms'] = round(elapsed_ms, 2)
+            self._metrics['total_flush_ms'] += elapsed_ms
+
+    def close(self, timeout=10):
+        """Stop the worker after flushing everything still queued."""
+        if not self._stop.is_set():
+            self._stop.set()
+            self._worker.join(timeout)
+
+    def stats(self):
+        """Queue depth and flush latency metrics."""
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics['queue_depth'] = self._queue.qsize() + len(self._pending)
+        metrics['avg_flush_ms'] = round(metrics.pop('total_flush_ms') / metrics['flushes'], 2) if metrics['flushes'] else 0.0
+        return metrics
 
 def fetch_history(conn, user_name):
     query = f"""
@@ -155,7 +464,7 @@ def fetch_history(conn, user_name):
     LIMIT 5
     """
     try:
-        result = conn.query(query, parameters={
+        result = conn.execute_read(query, parameters={
             'user_name': user_name})
         return result
     except Exception as e:
@@ -166,7 +475,7 @@ def remove_user(conn, username):
     MATCH (u:User {{username: $user_name}}) DETACH DELETE u
     """
     try:
-        result = conn.query(query, parameters={
+        result = conn.execute_write(query, parameters={
             'user_name': username})
         return result
     except Exception as e:
@@ -177,14 +486,14 @@ def get_statistics(conn):
     MATCH (u:User)
     WITH count(u) AS user_count
 
-    MATCH (a:Article) 
+    MATCH (a:Article) WHERE (a)<-[:SELECTED]-()
     WITH  user_count, count(a) AS selected_article_count
 
     MATCH (r:RecomArticle)
     RETURN user_count, selected_article_count, count(r) AS recom_article_count
     """
     try:
-        result = conn.query(query)
+        result = conn.execute_read(query)
         return result[0]
     except Exception as e:
         print(f"Error occured while fetching history: {e}")
@@ -195,6 +504,7 @@ def plot_statistics(stats):
         st.write("No data available for plotting.")
         return
     
+    import plotly.graph_objects as go
     labels = ['Users', 'Selected Articles', 'Recommended Articles']
     values = stats
 
@@ -1,55 +1,339 @@
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from transformers import BertTokenizer, BertModel
-import torch
+from Encoder_helper_func import encode_texts, encode_long_texts, encoder_tag, DEFAULT_MODEL
+from Cache_helper_func import EmbeddingCache
+from Index_helper_func import TfidfIndex, BM25Index, top_k
+from dataclasses import dataclass
 import numpy as np
+import time
 
-def vectorize_text(texts_lst, method='bert'):
+
+@dataclass(frozen=True)
+class Recommendation:
+    pmcid: str
+    title: str
+    abstract: str
+    similarity_score: float
+
+def cosine_similarity(X, Y):
+    # scikit-learn is imported on first use to keep the app start fast
+    from sklearn.metrics.pairwise import cosine_similarity as sk_cosine_similarity
+    return sk_cosine_similarity(X, Y)
+
+# Per stage latency of the last two stage (retrieve then rerank) recommendation
+_STAGE_TIMINGS = {}
+
+def get_stage_timings():
+    return dict(_STAGE_TIMINGS)
+
+def vectorize_text(texts_lst, method='bert', model_name=DEFAULT_MODEL):
     # Choose one methods
     if method == 'tfidf':
+        from sklearn.feature_extraction.text import TfidfVectorizer
         vectorizer = TfidfVectorizer(stop_words='english')
         return vectorizer.fit_transform(texts_lst)
     elif method == 'bert':
-        tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-        model = BertModel.from_pretrained('bert-base-uncased')
-        inputs = tokenizer(texts_lst, return_tensors="pt", truncation=True, padding=True)
-        outputs = model(**inputs)
-        return outputs.last_hidden_state.mean(dim=1).detach().numpy()
-    
-
-def get_similar_articles(selected_abstract, all_abstracts, method='bert'):
+        # Tokenizer and model are loaded once per process (see Encoder_helper_func)
+        return encode_texts(texts_lst, model_name)
+
+
+def embedding_keys(texts_lst, pmcids, section='Abstract', model_name=DEFAULT_MODEL):
+    tag = encoder_tag(model_name)
+    return [EmbeddingCache.make_key(pmcid, section, tag, text) for pmcid, text in zip(pmcids, texts_lst)]
+
+
+def vectorize_cached(texts_lst, pmcids, cache, section='Abstract', model_name=DEFAULT_MODEL):
+    # Look up every text in the embedding cache and only encode the missing ones
+    keys = embedding_keys(texts_lst, pmcids, section, model_name)
+    found = cache.get_many(keys)
+    missing = [i for i, key in enumerate(keys) if key not in found]
+    if missing:
+        new_vectors = vectorize_text([texts_lst[i] for i in missing], 'bert', model_name)
+        cache.put_many([keys[i] for i in missing], new_vectors)
+        for i, vector in zip(missing, new_vectors):
+            found[keys[i]] = vector
+    return np.vstack([found[key] for key in keys])
+
+
+def rerank(selected_abstract, candidate_texts, candidate_ids=None, selected_pmcid=None, cache=None):
+    # Second stage: BERT cosine similarity of the candidates only
+    texts = list(candidate_texts) + [selected_abstract]
+    if cache is not None and candidate_ids is not None and selected_pmcid is not None:
+        vectors = vectorize_cached(texts, list(candidate_ids) + [selected_pmcid], cache)
+    else:
+        vectors = vectorize_text(texts, 'bert')
+    return cosine_similarity(vectors[-1:], vectors[:-1]).flatten()
+
+
+def get_hybrid_similarity(selected_abstract, all_abstracts, pmcids=None, selected_pmcid=None, cache=None,
+                          first_stage='bm25', n_candidates=30):
+    """
+    Retrieve the top n_candidates lexically (TF-IDF or BM25) and rerank only those with BERT.
+    Non candidates get a score of -1 (the cosine minimum) so they rank last.
+    """
+    start = time.perf_counter()
+    ids = list(pmcids) if pmcids is not None else list(range(len(all_abstracts)))
+    lexical = BM25Index() if first_stage == 'bm25' else TfidfIndex()
+    lexical.fit(ids, list(all_abstracts))
+    candidates = top_k(lexical.score(selected_abstract), n_candidates)
+    retrieved = time.perf_counter()
+
+    scores = np.full(len(ids), -1.0, dtype=np.float32)
+    if len(candidates):
+        scores[candidates] = rerank(selected_abstract, [all_abstracts[i] for i in candidates],
+                                    [ids[i] for i in candidates] if pmcids is not None else None,
+                                    selected_pmcid, cache)
+    _STAGE_TIMINGS.clear()
+    _STAGE_TIMINGS.update({'first_stage': first_stage,
+                           'candidates': int(len(candidates)),
+                           'retrieve_ms': round((retrieved - start) * 1000, 2),
+                           'rerank_ms': round((time.perf_counter() - retrieved) * 1000, 2)})
+    return scores
+
+
+def retrieve_and_rerank(selected_abstract, lexical_index, store, cache=None, selected_pmcid=None,
+                        n_candidates=100, k=10, exclude=None):
+    """
+    Corpus wide two stage recommendation: a prebuilt TfidfIndex/BM25Index over the cached abstracts
+    retrieves n_candidates, which are reranked with (cached) BERT embeddings.
+    Returns a list of Recommendation like get_recommendation.
+    """
+    start = time.perf_counter()
+    ids, _ = lexical_index.search(selected_abstract, n_candidates, exclude=exclude)
+    # Metadata lookups, peek neither expires rows nor counts as cache hits/misses
+    infos = [next(iter((store.peek(pmcid) or {}).values()), {}) for pmcid in ids]
+    keep = [i for i, info in enumerate(infos) if info.get('Abstract')]
+    retrieved = time.perf_counter()
+
+    recommended = []
+    if keep:
+        scores = rerank(selected_abstract, [infos[i]['Abstract'] for i in keep], [ids[i] for i in keep],
+                        selected_pmcid, cache)
+        for j in top_k(scores, k):
+            info = infos[keep[j]]
+            recommended.append(Recommendation(pmcid=ids[keep[j]], title=info.get('Title', ''),
+                                              abstract=info.get('Abstract', ''), similarity_score=float(scores[j])))
+    _STAGE_TIMINGS.clear()
+    _STAGE_TIMINGS.update({'first_stage': type(lexical_index).__name__,
+                           'candidates': len(keep),
+                           'retrieve_ms': round((retrieved - start) * 1000, 2),
+                           'rerank_ms': round((time.perf_counter() - retrieved) * 1000, 2)})
+    return recommended
+
+
+def rescore_exact(scores, cache, keys, query_key, k=10, rescore=4):
+    # Compact (float16/int8) cached vectors only shortlist, the top k x rescore candidates get
+    # their exact cosine similarity from the cache's float32 sidecar (only those rows are read)
+    candidates = top_k(scores, min(k * rescore, len(scores)))
+    exact = cache.get_exact_many([keys[i] for i in candidates] + [query_key])
+    candidates = [i for i in candidates if keys[i] in exact]
+    if candidates and query_key in exact:
+        vectors = np.vstack([exact[keys[i]] for i in candidates])
+        scores = np.array(scores, dtype=np.float32)
+        scores[candidates] = cosine_similarity(exact[query_key][None], vectors).flatten()
+    return scores
+
+
+def get_similar_articles(selected_abstract, all_abstracts, method='bert', pmcids=None, selected_pmcid=None,
+                         cache=None, section='Abstract', tfidf_index=None, first_stage='bm25', n_candidates=30,
+                         k=10, rescore=4, tfidf_path=None):
+    if method == 'hybrid':
+        return get_hybrid_similarity(selected_abstract, list(all_abstracts), pmcids, selected_pmcid, cache,
+                                     first_stage, n_candidates)
+    if method == 'tfidf' and tfidf_index is not None and pmcids is not None:
+        # Fitted TF-IDF model: index the new abstracts and transform only the query; when the
+        # index grew it is saved in the background so the next process starts with them
+        if tfidf_index.add(list(pmcids), list(all_abstracts)) and tfidf_path is not None:
+            tfidf_index.schedule_save(tfidf_path)
+        return tfidf_index.score(selected_abstract, list(pmcids))
     # Vectorize both the selected abstract and all abstracts
-    all_abstracts.append(selected_abstract)
-    vectors = vectorize_text(all_abstracts, method)
-    # Convert it into array
-    if method == 'tfidf':
-        vectors = vectors.toarray() 
-    # Calculate cosine similarity (last added vector is the selected article)
-    similarity = cosine_similarity([vectors[-1]], vectors[:-1])
-    return similarity.flatten()
-
-def get_recommendation(similarity_scores, df):
-    # Sorting the similarity scores in descending order
-    sorted_indices = np.argsort(similarity_scores)[::-1]
-    # Number of top similar articles to display
-    top_5_dict = {} 
-    for idx in sorted_indices[:10]:
-        score = similarity_scores[idx]
-        pmcid = df.loc[idx, 'pmcid']
-        title = df.loc[idx, 'Title']
-        abstract = df.loc[idx, 'Abstract']
-        top_5_dict[pmcid] = {
-                'similarity_score': score,
-                'pmcid': pmcid,
-                'title': title,
-                'abstract': abstract}
-    return top_5_dict
-
-def display_recommended(article_df, recommend, keys, section, rec):
-    df = article_df[article_df['pmcid']==keys]
-    rec.write(f"Similarity score: {recommend[keys]['similarity_score']}")
-    rec.write(f"PMCID: {recommend[keys]['pmcid']}")
-    rec.write(f"Title: {recommend[keys]['title']}")
+    all_abstracts = list(all_abstracts) + [selected_abstract]
+    if method == 'bert' and cache is not None and pmcids is not None:
+        vectors = vectorize_cached(all_abstracts, list(pmcids) + [selected_pmcid], cache, section)
+    else:
+        vectors = vectorize_text(all_abstracts, method)
+    # Calculate cosine similarity (last added vector is the selected article),
+    # TF-IDF stays sparse instead of being densified
+    similarity = cosine_similarity(vectors[-1:], vectors[:-1]).flatten()
+    if method == 'bert' and cache is not None and pmcids is not None and cache.storage != 'float32' and rescore:
+        keys = embedding_keys(all_abstracts, list(pmcids) + [selected_pmcid], section)
+        similarity = rescore_exact(similarity, cache, keys[:-1], keys[-1], k, rescore)
+    return similarity
+
+############## Multi-field similarity #################
+FIELDS = ('Title', 'Abstract', 'Introduction', 'Methods', 'Results', 'Discussion')
+
+# Field weights of the similarity presets offered in the app
+FIELD_WEIGHT_PRESETS = {'balanced': {'Title': 1.0, 'Abstract': 2.0, 'Introduction': 1.0, 'Methods': 1.0,
+                                     'Results': 1.0, 'Discussion': 1.0},
+                        'methods-heavy': {'Title': 0.5, 'Abstract': 1.0, 'Methods': 4.0, 'Results': 1.0},
+                        'findings-heavy': {'Title': 0.5, 'Abstract': 1.0, 'Results': 3.0, 'Discussion': 2.0}}
+
+
+def field_vectors(article_df, fields=FIELDS, cache=None, model_name=DEFAULT_MODEL, max_chunks=8, pooling='mean'):
+    """
+    Embedding of every section of every article over its full text: all sections of all articles
+    are split into overlapping token windows that are encoded together (see encode_long_texts) and
+    pooled per section. Vectors are stored in the embedding cache under a section tag naming the
+    field and the windowing, so each section is only ever encoded once.
+    Returns:
+        tuple: (float32 array n_articles x n_fields x dim, bool array n_articles x n_fields of non empty fields)
+    """
+    pmcids = article_df['pmcid'].to_list()
+    texts = {field: article_df[field].fillna('').astype(str).to_list() if field in article_df else [''] * len(pmcids)
+             for field in fields}
+    slots = [(i, f) for f, field in enumerate(fields) for i in range(len(pmcids)) if texts[field][i].strip()]
+    tag = encoder_tag(model_name)
+    keys = [EmbeddingCache.make_key(pmcids[i], f'{fields[f]}#windows{max_chunks}{pooling}', tag, texts[fields[f]][i])
+            for i, f in slots]
+    found = cache.get_many(keys) if cache is not None else {}
+    missing = [j for j, key in enumerate(keys) if key not in found]
+    if missing:
+        new_vectors = encode_long_texts([texts[fields[slots[j][1]]][slots[j][0]] for j in missing], model_name,
+                                        max_chunks=max_chunks, pooling=pooling)
+        new_keys = [keys[j] for j in missing]
+        if cache is not None:
+            cache.put_many(new_keys, new_vectors)
+        found.update(zip(new_keys, new_vectors))
+
+    dim = len(next(iter(found.values()))) if found else 768
+    matrix = np.zeros((len(pmcids), len(fields), dim), dtype=np.float32)
+    mask = np.zeros((len(pmcids), len(fields)), dtype=bool)
+    for (i, f), key in zip(slots, keys):
+        matrix[i, f] = found[key]
+        mask[i, f] = True
+    return matrix, mask
+
+
+def weighted_field_similarity(query, query_mask, matrix, mask, weights):
+    """
+    Weighted mean over fields of the per field cosine similarity, as one batched operation.
+    Fields missing from the query or the candidate do not count.
+    Parameters:
+        query (numpy.ndarray): n_fields x dim field vectors of the selected article.
+        query_mask (numpy.ndarray): n_fields bool.
+        matrix (numpy.ndarray): n_articles x n_fields x dim field vectors of the candidates.
+        mask (numpy.ndarray): n_articles x n_fields bool.
+        weights (numpy.ndarray): n_fields field weights.
+    Returns:
+        numpy.ndarray: One score per candidate in [-1, 1] (0 when no field is shared).
+    """
+    eps = 1e-12
+    query = query / np.maximum(np.linalg.norm(query, axis=-1, keepdims=True), eps)
+    matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=-1, keepdims=True), eps)
+    cosine = np.einsum('fd,nfd->nf', query, matrix)
+    effective = mask * (np.asarray(weights, dtype=np.float32) * query_mask)
+    total = effective.sum(axis=1)
+    return np.where(total > 0, (cosine * effective).sum(axis=1) / np.maximum(total, eps), 0.0)
+
+
+def get_field_similarity(article_df, selected_article, weights='balanced', cache=None, fields=FIELDS,
+                         model_name=DEFAULT_MODEL):
+    """
+    Multi-field similarity of the selected article with every article of the DataFrame.
+    Parameters:
+        selected_article (pandas.Series): Row of the selected article (need not be in article_df).
+        weights (dict or str): Field --> weight (unlisted fields get 0) or a FIELD_WEIGHT_PRESETS name.
+    Returns:
+        numpy.ndarray: One score per row of article_df (positional).
+    """
+    if isinstance(weights, str):
+        weights = FIELD_WEIGHT_PRESETS[weights]
+    # Fields without weight do not change the score, so they are never encoded
+    fields = [field for field in fields if weights.get(field, 0.0)]
+    if not fields:
+        return np.zeros(len(article_df), dtype=np.float32)
+    weights = np.array([weights[field] for field in fields], dtype=np.float32)
+    matrix, mask = field_vectors(article_df, fields, cache, model_name)
+    query, query_mask = field_vectors(selected_article.to_frame().T, fields, cache, model_name)
+    return weighted_field_similarity(query[0], query_mask[0], matrix, mask, weights)
+
+
+def get_recommendation(similarity_scores, df, k=10, exclude_pmcid=None):
+    """
+    Top-k most similar articles of the DataFrame.
+    Parameters:
+        similarity_scores (numpy.ndarray): One score per row of df (positional).
+        df (pandas.DataFrame): Articles with 'pmcid', 'Title' and 'Abstract' columns.
+        k (int): Number of recommendations.
+        exclude_pmcid (str): PMCID of the query article, left out of the results.
+    Returns:
+        list: Recommendation objects, best first.
+    """
+    scores = np.asarray(similarity_scores, dtype=np.float64)
+    if exclude_pmcid is not None:
+        scores = np.where(df['pmcid'].to_numpy() == exclude_pmcid, -np.inf, scores)
+    # argpartition top-k instead of a full sort
+    idx = top_k(scores, k)
+    idx = idx[np.isfinite(scores[idx])]
+    # A single positional take, robust to the gaps dropna leaves in the index
+    rows = df[['pmcid', 'Title', 'Abstract']].iloc[idx].to_numpy()
+    return [Recommendation(pmcid=pmcid, title=title, abstract=abstract, similarity_score=float(score))
+            for (pmcid, title, abstract), score in zip(rows, scores[idx])]
+
+def blend_scores(similarity_scores, df, collab_scores, alpha=0.2):
+    """
+    Blend content (cosine) scores with collaborative scores.
+    Parameters:
+        similarity_scores (numpy.ndarray): One cosine score per row of df.
+        df (pandas.DataFrame): Articles with a 'pmcid' column.
+        collab_scores (dict): {pmcid: score} from the materialized SIMILAR_TO relationships.
+        alpha (float): Weight of the collaborative part.
+    Returns:
+        numpy.ndarray: (1 - alpha) * cosine + alpha * collaborative score scaled to [0, 1].
+    """
+    scores = np.asarray(similarity_scores, dtype=np.float64)
+    if not collab_scores or not alpha:
+        return scores
+    collab = df['pmcid'].map(collab_scores).fillna(0.0).to_numpy(dtype=np.float64)
+    peak = collab.max()
+    if peak > 0:
+        collab = collab / peak
+    return (1 - alpha) * scores + alpha * collab
+
+def personalize_recommendations(recommend, profile, cache=None, beta=0.2, k=None):
+    """
+    Rerank recommendations with the user's interest profile vector.
+    score = (1 - beta) * similarity + beta * cosine(article, profile)
+    """
+    if profile is None or not recommend or not beta:
+        return recommend[:k] if k else recommend
+    texts = [item.abstract for item in recommend]
+    if cache is not None:
+        vectors = vectorize_cached(texts, [item.pmcid for item in recommend], cache)
+    else:
+        vectors = vectorize_text(texts, 'bert')
+    affinity = cosine_similarity(vectors, profile.reshape(1, -1)).ravel()
+    scores = np.array([item.similarity_score for item in recommend]) * (1 - beta) + beta * affinity
+    order = top_k(scores, k or len(recommend))
+    return [Recommendation(pmcid=recommend[i].pmcid, title=recommend[i].title, abstract=recommend[i].abstract,
+                           similarity_score=float(scores[i])) for i in order]
+
+def get_index_recommendation(selected_abstract, index, store=None, k=10, exclude=None, selected_pmcid=None,
+                             cache=None):
+    # Query the prebuilt corpus index instead of the current search results
+    if cache is not None and selected_pmcid is not None:
+        query = vectorize_cached([selected_abstract], [selected_pmcid], cache)[0]
+    else:
+        query = vectorize_text([selected_abstract], 'bert')[0]
+    exclude = set(exclude or [])
+    ids, scores = index.search(query, k + len(exclude))
+    recommended = []
+    for pmcid, score in zip(ids, scores):
+        if pmcid in exclude:
+            continue
+        info = {}
+        if store is not None:
+            info = next(iter((store.peek(pmcid) or {}).values()), {})
+        recommended.append(Recommendation(pmcid=pmcid, title=info.get('Title', ''),
+                                          abstract=info.get('Abstract', ''), similarity_score=float(score)))
+        if len(recommended) == k:
+            break
+    return recommended
+
+def display_recommended(article_df, item, section, rec):
+    df = article_df[article_df['pmcid']==item.pmcid]
+    rec.write(f"Similarity score: {item.similarity_score}")
+    rec.write(f"PMCID: {item.pmcid}")
+    rec.write(f"Title: {item.title}")
     rec.text_area(f"**{section}:**", df[section].iloc[0], height=250)
-    return recommend[keys]
+    return item
 
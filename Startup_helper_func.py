@@ -0,0 +1,110 @@
+import sys
+import time
+import argparse
+import threading
+import subprocess
+
+# Modules imported by the Streamlit app, in import order
+APP_MODULES = ['streamlit', 'pandas', 'API_helper_func', 'Recommend_helper_func', 'Encoder_helper_func',
+               'Cache_helper_func', 'Index_helper_func', 'Neo4j_helper_func', 'Collab_helper_func',
+               'Entity_helper_func', 'spacy_helper_func']
+
+# Heavy libraries that should only be imported lazily
+HEAVY_MODULES = ['torch', 'transformers', 'sklearn', 'spacy', 'google.generativeai', 'matplotlib', 'plotly']
+
+
+############## Background prewarming #################
+_PREWARM_TIMINGS = {}
+
+
+def _prewarm_encoder():
+    from Encoder_helper_func import warm_up_encoder
+    warm_up_encoder()
+
+
+def _prewarm_nlp():
+    from spacy_helper_func import get_nlp
+    get_nlp()
+
+
+def _prewarm_genai():
+    from spacy_helper_func import get_genai
+    get_genai()
+
+
+PREWARM_TASKS = {'encoder': _prewarm_encoder, 'nlp': _prewarm_nlp, 'genai': _prewarm_genai}
+
+
+def prewarm(tasks=('encoder', 'nlp', 'genai')):
+    """
+    Load the heavy models in a daemon thread (e.g. right after login) so the first use of a tab is fast.
+    Returns:
+        threading.Thread: The started thread.
+    """
+    def run():
+        for name in tasks:
+            start = time.perf_counter()
+            try:
+                PREWARM_TASKS[name]()
+                _PREWARM_TIMINGS[name] = round(time.perf_counter() - start, 3)
+            except Exception as e:
+                print(f"Prewarming {name} failed: {e}")
+                _PREWARM_TIMINGS[name] = None
+    thread = threading.Thread(target=run, name='prewarm', daemon=True)
+    thread.start()
+    return thread
+
+
+def get_prewarm_timings():
+    """Seconds each prewarm task took (None if it failed)."""
+    return dict(_PREWARM_TIMINGS)
+
+
+############## Import time report #################
+def parse_importtime(stderr):
+    """Parse the `-X importtime` output into {module: (self_us, cumulative_us)}."""
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def import_time_report(modules=APP_MODULES, top=15):
+    """
+    Import the modules in a fresh interpreter with `-X importtime` and summarize the cost.
+    Returns:
+        dict: Total import time, the heavy libraries that were imported eagerly and the slowest modules.
+    """
+    code = '; '.join(f'import {module}' for module in modules)
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    wall_s = time.perf_counter() - start
+    if process.returncode != 0:
+        print(process.stderr.splitlines()[-1] if process.stderr else "Import failed")
+    timings = parse_importtime(process.stderr)
+    slowest = sorted(timings.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    return {'wall_s': round(wall_s, 3),
+            'modules': len(timings),
+            'total_self_ms': round(sum(self_us for self_us, _ in timings.values()) / 1000, 1),
+            'eager_heavy_imports': [name for name in HEAVY_MODULES if name in timings],
+            'slowest_ms': {name: round(cumulative / 1000, 1) for name, (_, cumulative) in slowest}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize the cold start import time of the app modules.")
+    parser.add_argument('modules', nargs='*', default=APP_MODULES)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args(argv)
+    report = import_time_report(args.modules, args.top)
+    print(f"Imported {report['modules']} modules in {report['wall_s']} s "
+          f"({report['total_self_ms']} ms of import work)")
+    print("Heavy libraries imported eagerly:", ', '.join(report['eager_heavy_imports']) or 'none')
+    for name, ms in report['slowest_ms'].items():
+        print(f"{ms:>10.1f} ms  {name}")
+
+
+if __name__ == '__main__':
+    main()
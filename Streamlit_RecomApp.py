@@ -1,16 +1,20 @@
+import os
+import time
 import streamlit as st
 import pandas as pd
-import torch
 from API_helper_func import *
 from Recommend_helper_func import *
-import matplotlib.pyplot as plt
+from Encoder_helper_func import get_encoder_stats, get_encode_stats
+from Cache_helper_func import EmbeddingCache, ArticleStore, RecommendationCache
+from Index_helper_func import VectorIndex, TfidfIndex, INDEX_DIR, TFIDF_PATH
 from Neo4j_helper_func import *
+from Collab_helper_func import fetch_similar_to, fetch_user_suggestions
+from Entity_helper_func import EntityIndex, EntityIngestor
 from secret_keys import *
 from spacy_helper_func import *
+from Startup_helper_func import prewarm, get_prewarm_timings
 from datetime import date
-import google.generativeai as genai
 
-genai.configure(api_key=gemini_api_key)
 # Set page config
 def set_page_layout(page_title, layout):
     st.set_page_config(page_title=page_title, layout=layout) # --> "wide", "centered"
@@ -18,8 +22,80 @@ def set_page_layout(page_title, layout):
     st.logo(image="icon.png", 
             icon_image="icon.png", size='large') 
 
+# Load the encoder, spaCy and Gemini once per server process in the background (PREWARM=0 disables it),
+# so the login page renders without waiting for the models
+@st.cache_resource
+def start_prewarm():
+    if os.environ.get('PREWARM', '1') == '0':
+        return None
+    return prewarm()
+
+# Embedding store shared by all sessions and persisted across restarts
+@st.cache_resource
+def get_embedding_cache():
+    # EMBEDDING_STORAGE=float16/int8 halves/quarters the cache size
+    return EmbeddingCache(storage=os.environ.get('EMBEDDING_STORAGE', 'float32'))
+
+# Recommendation results per (selected article, result set, method), shared by all sessions
+@st.cache_resource
+def get_recommendation_cache():
+    return RecommendationCache()
+
+# Local store of fetched BioC articles shared by all sessions
+@st.cache_resource
+def get_article_store():
+    return ArticleStore(offline=os.environ.get('ARTICLE_STORE_OFFLINE') == '1')
+
+# Prebuilt corpus wide nearest neighbour index (None until it has been built)
+@st.cache_resource
+def get_vector_index():
+    if not os.path.exists(os.path.join(INDEX_DIR, 'meta.json')):
+        return None
+    return VectorIndex.load(INDEX_DIR)
+
+# Prebuilt TF-IDF index over the cached abstracts, first stage of corpus recommendations
+@st.cache_resource
+def get_lexical_index():
+    if not os.path.exists(TFIDF_PATH):
+        # Fitted on the first add (the tfidf method indexes the search results)
+        return TfidfIndex()
+    return TfidfIndex.load(TFIDF_PATH)
+
+# Inverted entity index shared by all sessions
+@st.cache_resource
+def get_entity_index():
+    return EntityIndex()
+
 ########## User Authentication ##############
-neo4j_conn = Neo4jConnection(uri="neo4j://localhost:7687", user=neo4j_user, pwd=neo4j_passwd)
+# One driver (and connection pool) per server process instead of one per script run
+@st.cache_resource
+def get_neo4j_connection():
+    return Neo4jConnection(uri="neo4j://localhost:7687", user=neo4j_user, pwd=neo4j_passwd)
+
+neo4j_conn = get_neo4j_connection()
+
+# Constraints are created once per server process instead of on every write
+@st.cache_resource
+def bootstrap_schema():
+    if not ensure_schema(neo4j_conn):
+        # Raising keeps the failure out of the cache, the next script run tries again
+        raise RuntimeError("Neo4j schema setup failed")
+    return True
+
+try:
+    bootstrap_schema()
+except RuntimeError as e:
+    print(e)
+
+# Interaction logging happens in the background, shared by all sessions
+@st.cache_resource
+def get_interaction_writer():
+    return InteractionWriter(neo4j_conn)
+
+# Entity extraction of the fetched articles runs in the background, shared by all sessions
+@st.cache_resource
+def get_entity_ingestor():
+    return EntityIngestor(neo4j_conn, get_entity_index())
 
 session_defaults = {
     "logged_in": None,
@@ -28,7 +104,10 @@ session_defaults = {
     "look": False,
     "user": None,
     "keyword": None,
-    "data": None
+    "data": None,
+    "pending_ids": [],
+    "fetch_started": None,
+    "first_article_s": None
 }
 for key, default in session_defaults.items():
     if key not in st.session_state:
@@ -55,18 +134,13 @@ if not st.session_state.logged_in:
                 st.error("Passwords do not match. Please try again.")
             else:
                 try:
-                    user_info, user_lst = fetch_users(neo4j_conn)
-
-                    # Check if the username already exists
-                    if reg_username in user_lst:
-                        # Check if the account matches the provided details
-                        if (reg_firstname == user_info[reg_username]["first_name"] and 
-                            reg_lastname == user_info[reg_username]["last_name"]):
-                            st.error("Account already exists. Try logging in.")
-                        else:
-                            st.error("Username already taken. Please choose a different one.")
+                    # Creates the user only if the username is free
+                    result = register_user(neo4j_conn, reg_firstname, reg_lastname, reg_username, reg_password)
+                    if result == RegistrationResult.EXISTS:
+                        st.error("Account already exists. Try logging in.")
+                    elif result == RegistrationResult.TAKEN:
+                        st.error("Username already taken. Please choose a different one.")
                     else:
-                        register_user(neo4j_conn, reg_firstname, reg_lastname, reg_username, reg_password)
                         st.success("Registration successful! You can now log in.")
                 except Exception as e:
                     st.error(f"Registration failed: {e}")
@@ -102,6 +176,32 @@ elif st.session_state.user == 'admin':
         if st.button('Get statistics'):
             stats = get_statistics(neo4j_conn)
             plot_statistics(stats)
+
+    with st.expander('Encoder'):
+        # Load time and resident memory of the shared encoder
+        encoder_stats = get_encoder_stats()
+        if encoder_stats:
+            st.json(encoder_stats)
+        else:
+            st.info("Encoder not loaded yet in this server process.")
+        st.write("Background prewarm (seconds)")
+        st.json(get_prewarm_timings())
+        st.write("Last encoding run")
+        st.json(get_encode_stats())
+        st.write("Embedding cache")
+        st.json(get_embedding_cache().stats())
+        st.write("Recommendation cache")
+        st.json(get_recommendation_cache().stats())
+
+    with st.expander('Interaction writer'):
+        st.json(get_interaction_writer().stats())
+        st.write("Entity ingestion")
+        st.json(get_entity_ingestor().stats())
+        st.write("Neo4j queries")
+        st.json(neo4j_conn.get_query_stats())
+
+    with st.expander('Article store'):
+        st.json(get_article_store().stats())
             
     with st.expander("User management"):
         user_name = st.text_input("Username")
@@ -115,6 +215,8 @@ else:
     # Multiple tabs for recommendation & NLP tasks
     tab1, tab2, tab3 = st.tabs(["Home", "NLP", "History"])
 
+    start_prewarm()
+
     with tab1:
         st.title('Article Recommendation System')
         with st.expander('Info'):
@@ -142,11 +244,23 @@ else:
                 st.error("Starting date must be earlier than the ending date!")
             retmode = st.radio('Pick one', ['json', 'xml'])
             retmax = st.selectbox('Select:', [10, 20, 50, 100])
+            method = st.selectbox('Recommendation method', ['bert', 'hybrid', 'tfidf', 'fields'])
+            n_candidates = 30
+            field_weights = None
+            if method == 'hybrid':
+                # Only the top lexical candidates are encoded with BERT
+                n_candidates = st.slider('BERT rerank candidates', min_value=11, max_value=100, value=30)
+            elif method == 'fields':
+                # Weighted similarity of every section (full text), not just the abstract
+                field_weights = st.selectbox('Section weighting', list(FIELD_WEIGHT_PRESETS))
+            # Weight of "users who selected this also selected" in the ranking
+            collab_weight = st.slider('Collaborative weight', min_value=0.0, max_value=1.0, value=0.2, step=0.05)
             status = st.button('Proceed')
 
             if st.button("New Search"):
                 # Clear relevant session state keys
-                keys_to_clear = ["selected_article", "recommended_articles", "look", "keys", "article_df", "data"]
+                keys_to_clear = ["selected_article", "recommended_articles", "look", "keys", "article_df", "data",
+                                 "pending_ids", "first_article_s"]
                 for key in keys_to_clear:
                     if key in st.session_state:
                         st.session_state[key] = None
@@ -155,7 +269,8 @@ else:
                     "selected_article": pd.DataFrame(),
                     "recommended_articles": pd.DataFrame(),
                     "look": False,
-                    "keys": None
+                    "keys": None,
+                    "pending_ids": []
                 }
                 for key, default in reset_defaults.items():
                     st.session_state[key] = default
@@ -177,14 +292,18 @@ else:
             }
 
             if retmode == "json":
-                # API calls
-                with st.spinner("Fetching data..."):
+                # API call for the ids, the articles are streamed in at the end of the page
+                with st.spinner("Searching..."):
                     data, article_ids = fetch_article_id(**params)
-                    article_df = run_script(article_ids)
 
-                # Save the DataFrame to session state
-                st.session_state.article_df = article_df
+                st.session_state.article_df = pd.DataFrame()
+                # The previous selection belongs to the previous results
+                st.session_state.look = False
+                st.session_state.selected_article = pd.DataFrame()
                 st.session_state.data = data
+                st.session_state.pending_ids = list(article_ids)
+                st.session_state.fetch_started = time.perf_counter()
+                st.session_state.first_article_s = None
 
             else:
                 st.warning("Work in progress for XML format...")
@@ -192,11 +311,20 @@ else:
         article_df = st.session_state.article_df
 
         # Visualizing Data Expander
-        with st.expander("Data"):
+        with st.expander("Data", expanded=bool(st.session_state.pending_ids)):
+            fetch_status = st.empty()
+            data_placeholder = st.empty()
+            entity_filter = st.text_input("Filter by entity (e.g. a gene or disease)", key="entity_filter")
             if st.session_state["article_df"].empty:
-                st.warning("No data available. Please search to load data.")
+                data_placeholder.warning("No data available. Please search to load data.")
+            elif entity_filter.strip():
+                # Indexed lookup in the entity index, no parsing
+                matching = get_entity_index().filter(st.session_state["article_df"]['pmcid'].to_list(), entity_filter)
+                data_placeholder.dataframe(st.session_state["article_df"][st.session_state["article_df"]['pmcid'].isin(matching)])
             else:
-                st.dataframe(st.session_state["article_df"])
+                data_placeholder.dataframe(st.session_state["article_df"])
+            if st.session_state.first_article_s is not None:
+                fetch_status.caption(f"First article after {st.session_state.first_article_s:.2f} s")
 
         # Information about total hits and data retrieved
         with st.expander('**Visualisation**'):
@@ -215,6 +343,7 @@ else:
                     # Bar graph
                     with col1:
                         st.subheader("Total vs Returned Results")
+                        import matplotlib.pyplot as plt
                         fig, ax = plt.subplots(figsize=(4, 5))
                         ax.bar(["Total Results", "Returned Results"], [total_results, returned_results], color=["blue", "orange"])
                         ax.set_ylabel("Count")
@@ -240,14 +369,17 @@ else:
                 if "slider_val" not in st.session_state:
                     st.session_state.slider_val = 1 
 
-                # Slider for selecting an abstract
-                val = st.slider(
-                    "Select Article Index", 
-                    min_value=1, 
-                    max_value=min(retmax, len(article_df)), 
-                    value=st.session_state.slider_val,
-                    step=1
-                )
+                # Slider for selecting an abstract (more articles may still be streaming in)
+                if len(article_df) > 1:
+                    val = st.slider(
+                        "Select Article Index", 
+                        min_value=1, 
+                        max_value=len(article_df), 
+                        value=min(st.session_state.slider_val, len(article_df)),
+                        step=1
+                    )
+                else:
+                    val = 1
 
                 # Fetch the selected article details
                 if "selected_article" not in st.session_state:
@@ -266,35 +398,67 @@ else:
                         # Add to Neo4j
                         user = st.session_state.get("user", "")
                         keyword = st.session_state.get("keyword", "")
-                        add_selected(neo4j_conn, selected_article, user, keyword)
+                        get_interaction_writer().submit_selected(selected_article, user, keyword)
+                        # Fold the selection into the user's interest profile, encoded on the writer thread
+                        # (a BERT forward pass on an embedding cache miss)
+                        abstract, pmcid = selected_article['Abstract'], selected_article['pmcid']
+                        cache = get_embedding_cache()
+                        get_interaction_writer().submit_profile(
+                            user, lambda: vectorize_cached([abstract], [pmcid], cache)[0])
                 else:
                     st.warning("No articles to display.")
 
         selected_article = st.session_state.selected_article
 
-        # Recommend articles based on cosine similarity
-        if st.session_state.look:
+        # Recommend articles based on cosine similarity (once the new results have started streaming in)
+        if st.session_state.look and not article_df.empty:
             with st.spinner("Looking for similar articles..."):
                 with st.expander("**Recommended articles**"):
-                    article = selected_article
-                    article = article['Abstract']
-                    all_abstracts = article_df['Abstract'].to_list()
-
-                    # Vectorization and cosine similarity
-                    similarity = get_similar_articles(article, all_abstracts, method='bert')
-                    recommend = get_recommendation(similarity, article_df)
-
-                    # Adding recommended to database
-                    selected = st.session_state.selected_article
                     user = st.session_state.user
-                    add_recommended(neo4j_conn, recommend, selected, user)
+                    rec_cache = get_recommendation_cache()
+                    key = rec_cache.make_key(selected_article['pmcid'], article_df, method,
+                                             n_candidates=n_candidates, collab_weight=collab_weight,
+                                             field_weights=field_weights)
+
+                    # Scored once per selection and result set, later reruns read the cache
+                    def score_candidates():
+                        # Vectorization and cosine similarity
+                        if method == 'fields':
+                            similarity = get_field_similarity(article_df, selected_article, field_weights,
+                                                              cache=get_embedding_cache())
+                        else:
+                            similarity = get_similar_articles(selected_article['Abstract'],
+                                                              article_df['Abstract'].to_list(), method=method,
+                                                              pmcids=article_df['pmcid'].to_list(),
+                                                              selected_pmcid=selected_article['pmcid'],
+                                                              cache=get_embedding_cache(),
+                                                              tfidf_index=get_lexical_index(),
+                                                              tfidf_path=TFIDF_PATH,
+                                                              n_candidates=n_candidates, k=20)
+                        collab_scores = fetch_similar_to(neo4j_conn, selected_article['pmcid'])
+                        similarity = blend_scores(similarity, article_df, collab_scores, alpha=collab_weight)
+                        return get_recommendation(similarity, article_df, k=20,
+                                                  exclude_pmcid=selected_article['pmcid'])
+
+                    # Personalized rerank of the candidates with the user's profile vector
+                    def personalize():
+                        candidates, _ = rec_cache.get_or_compute(key, score_candidates)
+                        profile = fetch_user_profile(neo4j_conn, user)
+                        return personalize_recommendations(candidates, profile, get_embedding_cache(), k=10)
+
+                    recommend, computed = rec_cache.get_or_compute(key + (('user', user),), personalize)
+                    if computed:
+                        if method == 'hybrid':
+                            st.caption(f"Stage timings: {get_stage_timings()}")
+                        # Adding recommended to database (once per user and selection)
+                        get_interaction_writer().submit_recommended(recommend, selected_article, user)
 
                     # Recommend articles in different tabs
                     rec1, rec2, rec3, rec4, rec5 = st.tabs(['Article 1', 'Article 2', 'Article 3', 'Article 4', 'Article 5'])
                     # Adding keys to session state
                     if 'keys' not in st.session_state:
                         st.session_state.keys = None
-                    keys = list(recommend.keys())
+                    keys = [item.pmcid for item in recommend]
                     st.session_state.keys = keys
                     section = st.selectbox(
                             "Pick a section:", ['Abstract', 'Introduction', 'Methods', 'Results', 'Discussion'], 
@@ -305,10 +469,66 @@ else:
                     rec_lst = [rec1, rec2, rec3, rec4, rec5]
                     rec_df_lst = []
                     # Articles
-                    for idx, rec in enumerate(rec_lst):
-                        info = display_recommended(article_df, recommend, keys[idx+1], section, rec)
+                    for rec, item in zip(rec_lst, recommend):
+                        info = display_recommended(article_df, item, section, rec)
                         rec_df_lst.append(info)
 
+            # Recommendations from the prebuilt corpus indexes (see Index_helper_func)
+            vector_index = get_vector_index()
+            lexical_index = get_lexical_index()
+            # The corpus expander needs a non empty lexical index or a vector index
+            if not len(lexical_index):
+                lexical_index = None
+            if vector_index is not None or lexical_index is not None:
+                with st.expander("**Recommended from the corpus**"):
+                    corpus_index = lexical_index if lexical_index is not None else vector_index
+                    # The index size changes the key when the index grows, so stale results are not served
+                    corpus_key = (selected_article['pmcid'], 'corpus', type(corpus_index).__name__,
+                                  id(corpus_index), len(corpus_index))
+
+                    def corpus_candidates():
+                        if lexical_index is not None:
+                            # Lexical candidates reranked with BERT
+                            return retrieve_and_rerank(selected_article['Abstract'], lexical_index,
+                                                       get_article_store(), cache=get_embedding_cache(),
+                                                       selected_pmcid=selected_article['pmcid'],
+                                                       n_candidates=100, k=5, exclude=[selected_article['pmcid']])
+                        return get_index_recommendation(selected_article['Abstract'], vector_index,
+                                                        store=get_article_store(), k=5,
+                                                        exclude=[selected_article['pmcid']],
+                                                        selected_pmcid=selected_article['pmcid'],
+                                                        cache=get_embedding_cache())
+
+                    corpus_recommend, computed = get_recommendation_cache().get_or_compute(corpus_key,
+                                                                                           corpus_candidates)
+                    if computed and lexical_index is not None:
+                        st.caption(f"Stage timings: {get_stage_timings()}")
+                    for item in corpus_recommend:
+                        st.write(f"**{item.title}** ({item.pmcid}), similarity score: {item.similarity_score:.4f}")
+
+
+        # Stream the remaining articles of the search into the Data expander
+        if st.session_state.pending_ids:
+            articles = iter_articles(list(st.session_state.pending_ids), store=get_article_store())
+            for id, article_data in articles:
+                st.session_state.pending_ids.remove(id)
+                new_rows = articles_to_df(article_data)
+                if not new_rows.empty:
+                    st.session_state.article_df = pd.concat([st.session_state.article_df, new_rows], ignore_index=True)
+                    data_placeholder.dataframe(st.session_state.article_df)
+                fetch_status.caption(f"Fetched {len(st.session_state.article_df)} articles, "
+                                     f"{len(st.session_state.pending_ids)} remaining...")
+                if st.session_state.first_article_s is None and not new_rows.empty:
+                    st.session_state.first_article_s = time.perf_counter() - st.session_state.fetch_started
+                    # Rerun so the article selector shows up while the rest keeps streaming. Closing the
+                    # generator first lets the requests in flight land in the article store, so the
+                    # rerun reads them back instead of fetching them again
+                    articles.close()
+                    st.rerun()
+            fetch_status.caption(f"Fetched {len(st.session_state.article_df)} articles, "
+                                 f"first article after {st.session_state.first_article_s or 0:.2f} s")
+            # Ingestion stage: bulk entity extraction into the entity index and Neo4j, off the script thread
+            get_entity_ingestor().submit(st.session_state.article_df)
 
     with tab2:
         nlp, chat = st.columns(2)
@@ -353,34 +573,36 @@ else:
                 text_to_process = text_area if text_area else text
 
                 if text_to_process.strip():
+                    # One cached parse serves every task, switching tasks does not re-parse
+                    analysis = analyze(text_to_process) if task != 'None' else {}
                     # Perform NLP tasks based on the selected task
                     if task == 'Tokenize':
-                        tokens = get_tokenized_text(text_to_process)
+                        tokens = analysis['tokens']
                         st.write("### Tokens")
                         st.markdown(" | ".join(tokens))
 
                     elif task == 'Sentencize':
-                        sentences = get_sentences(text_to_process)
+                        sentences = analysis['sentences']
                         st.write("### Sentences")
                         for i, sentence in enumerate(sentences, 1):
                             st.markdown(f"**Sentence {i}:** {sentence}")
 
                     elif task == 'NER':
-                        entities = get_ner(text_to_process)
+                        entities = analysis['entities']
                         st.write("### Named Entities")
                         if entities:
                             entity_df = pd.DataFrame(entities, columns=["Entity", "Label"])
                             st.table(entity_df)
 
                     elif task == 'Lemmatize':
-                        lemmas = lemmatize_text(text_to_process)
+                        lemmas = analysis['lemmas']
                         st.write("### Lemmas")
                         if lemmas:
                             lemma_df = pd.DataFrame(lemmas, columns=["Original form", "Lemma form"])
                             st.table(lemma_df)
 
                     elif task == 'POS tag':
-                        pos = get_pos_tags(text_to_process)
+                        pos = analysis['pos']
                         st.write("### POS tags")
                         if pos:
                             pos_df = pd.DataFrame(pos, columns=["Text", "POS", "Tag"])
@@ -405,3 +627,9 @@ else:
         history = pd.DataFrame(history, columns=['Search term', 'pmcid', 'title'])
         st.dataframe(history)
 
+
+        # Collaborative suggestions from the materialized SIMILAR_TO graph
+        st.subheader("Users who selected your articles also selected")
+        suggestions = fetch_user_suggestions(neo4j_conn, user)
+        suggestions = pd.DataFrame(suggestions, columns=['pmcid', 'title', 'score', 'co-selections'])
+        st.dataframe(suggestions)
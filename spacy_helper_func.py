@@ -1,40 +1,128 @@
-import spacy
+import threading
 import streamlit as st
-import google.generativeai as genai
 from secret_keys import *
 
-nlp = spacy.load("en_core_web_sm")
+# spaCy and the Gemini client are slow to import, they are loaded on first use
+_nlp = None
+_nlp_lock = threading.Lock()
+_genai = None
+
+def get_nlp():
+    """The shared en_core_web_sm pipeline, loaded on first use."""
+    global _nlp
+    if _nlp is None:
+        with _nlp_lock:
+            if _nlp is None:
+                import spacy
+                nlp = spacy.load("en_core_web_sm")
+                # The sentence recognizer is off by default, it is used for sentence only analysis
+                if 'senter' in nlp.disabled:
+                    nlp.enable_pipe('senter')
+                _nlp = nlp
+    return _nlp
+
+def get_genai():
+    """The configured google.generativeai module, imported on first use."""
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+        genai.configure(api_key=gemini_api_key)
+        _genai = genai
+    return _genai
+
+############## Analysis engine #################
+ALL_TASKS = ('tokens', 'sentences', 'entities', 'lemmas', 'pos')
+
+# Pipeline components each task needs (the tokenizer always runs)
+TASK_COMPONENTS = {
+    'tokens': [],
+    'sentences': ['senter'],
+    'entities': ['tok2vec', 'ner'],
+    'lemmas': ['tok2vec', 'tagger', 'attribute_ruler', 'lemmatizer'],
+    'pos': ['tok2vec', 'tagger', 'attribute_ruler'],
+}
+
+def components_for(tasks):
+    """Names of the components to disable for the given tasks."""
+    needed = set()
+    for task in tasks:
+        needed.update(TASK_COMPONENTS[task])
+    return [name for name in get_nlp().pipe_names if name not in needed]
+
+def doc_to_result(doc, tasks):
+    """Plain (cacheable) annotations of a Doc for the given tasks."""
+    result = {}
+    if 'tokens' in tasks:
+        result['tokens'] = [token.text for token in doc]
+    if 'sentences' in tasks:
+        result['sentences'] = [sent.text for sent in doc.sents]
+    if 'entities' in tasks:
+        result['entities'] = [(ent.text, ent.label_) for ent in doc.ents]
+    if 'lemmas' in tasks:
+        result['lemmas'] = [(token.text, token.lemma_) for token in doc]
+    if 'pos' in tasks:
+        result['pos'] = [(token.text, token.pos_, token.tag_) for token in doc]
+    return result
+
+def _process(text, tasks):
+    nlp = get_nlp()
+    if set(tasks) == {'tokens'}:
+        return nlp.make_doc(text)
+    return nlp(text, disable=components_for(tasks))
 
-############## NLP functions #################
 @st.cache_data
+def analyze(text, tasks=ALL_TASKS):
+    """Parse the text once with only the components the tasks need and return all their annotations."""
+    tasks = tuple(tasks)
+    return doc_to_result(_process(text, tasks), tasks)
+
+def analyze_batch(texts, tasks=ALL_TASKS, n_process=1, batch_size=64):
+    """
+    Analyse many texts with nlp.pipe.
+    Parameters:
+        texts (list): Texts to analyse.
+        tasks (tuple): Subset of ALL_TASKS.
+        n_process (int): Number of worker processes (-1 uses all CPUs).
+        batch_size (int): Texts per batch.
+    Returns:
+        list: One annotation dict per text, in input order.
+    """
+    tasks = tuple(tasks)
+    nlp = get_nlp()
+    if set(tasks) == {'tokens'}:
+        docs = nlp.tokenizer.pipe(texts, batch_size=batch_size)
+    else:
+        docs = nlp.pipe(texts, disable=components_for(tasks), n_process=n_process, batch_size=batch_size)
+    return [doc_to_result(doc, tasks) for doc in docs]
+
+def analyze_articles(article_df, sections=('Abstract', 'Introduction', 'Methods', 'Results', 'Discussion'),
+                     tasks=ALL_TASKS, n_process=1, batch_size=64):
+    """Analyse every section of every fetched article at once: {(pmcid, section): annotations}."""
+    keys = []
+    texts = []
+    for _, row in article_df.iterrows():
+        for section in sections:
+            text = row.get(section)
+            if isinstance(text, str) and text.strip():
+                keys.append((row['pmcid'], section))
+                texts.append(text)
+    return dict(zip(keys, analyze_batch(texts, tasks, n_process, batch_size)))
+
+############## NLP functions #################
 def get_tokenized_text(text):
-    doc = nlp(text)
-    tokens = [token.text for token in doc]
-    return tokens
+    return analyze(text, ('tokens',))['tokens']
 
-@st.cache_data
 def get_ner(text):
-    doc = nlp(text)
-    entities = [(ent.text, ent.label_) for ent in doc.ents]
-    return entities
+    return analyze(text, ('entities',))['entities']
 
-@st.cache_data
 def get_pos_tags(text):
-    doc = nlp(text)
-    pos_tags = [(token.text, token.pos_, token.tag_) for token in doc]
-    return pos_tags
+    return analyze(text, ('pos',))['pos']
 
-@st.cache_data
 def lemmatize_text(text):
-    doc = nlp(text)
-    lemmas = [(token.text, token.lemma_) for token in doc]
-    return lemmas
+    return analyze(text, ('lemmas',))['lemmas']
 
-@st.cache_data
 def get_sentences(text):
-    doc = nlp(text)
-    sentences = [sent.text for sent in doc.sents]
-    return sentences
+    return analyze(text, ('sentences',))['sentences']
 
 def genai_response(question):
     generation_config = {
@@ -45,7 +133,7 @@ def genai_response(question):
     "response_mime_type": "text/plain",
     }
 
-    model = genai.GenerativeModel(model_name='gemini-pro', generation_config=generation_config)
+    model = get_genai().GenerativeModel(model_name='gemini-pro', generation_config=generation_config)
     prompt = f"""
     Hey, you're a personal assistant and an expert in Natural Language Processing and Biomedical domain.
     Explain the following question in about 50 to 100 words: